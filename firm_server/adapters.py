@@ -1,4 +1,16 @@
-from typing import Any, AsyncIterable, Generator, Iterable, MutableMapping
+import asyncio
+import contextlib
+import importlib.util
+import logging
+import time
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Generator,
+    Iterable,
+    MutableMapping,
+)
 
 import httpx
 from firm.interfaces import (
@@ -27,6 +39,15 @@ from starlette.authentication import (
 from starlette.requests import HTTPConnection, Request
 from starlette.responses import Response
 
+from firm_server.cache import MISSING
+from firm_server.config import HttpClientConfig
+from firm_server.encoding import loads
+from firm_server.health import CircuitOpenError, HostHealthRegistry
+from firm_server.middleware import BODY_SCOPE_KEY
+from firm_server.timing import phase
+
+log = logging.getLogger(__name__)
+
 
 class HttpxAuthAdapter(httpx.Auth):
     def __init__(self, auth: HttpRequestSigner, store: ResourceStore) -> None:
@@ -144,6 +165,7 @@ class HttpConnectionAdapter(HttpRequest):
     def __init__(self, conn: HTTPConnection, store: ResourceStore):
         self._conn = conn
         self._store = store
+        self._json: Any = MISSING
 
     @property
     def method(self) -> HttpMethod:
@@ -176,20 +198,27 @@ class HttpConnectionAdapter(HttpRequest):
         """The IP address and port of the client making the request."""
         raise NotImplementedError()
 
-    def stream(self) -> AsyncIterable[bytes]:
+    async def stream(self) -> AsyncIterable[bytes]:
         """Asynchronous stream of the request body."""
-        raise NotImplementedError()
+        yield await self.body()
 
     def content(self) -> bytes:
-        return self._conn.content
+        return self._conn.scope.get(BODY_SCOPE_KEY, b"")
 
     async def body(self) -> bytes:
         """Read the entire request body at once as bytes."""
-        return self._conn.content
+        if (body := self._conn.scope.get(BODY_SCOPE_KEY)) is None:
+            # Not read by BodyLimitMiddleware
+            if not isinstance(self._conn, Request):
+                return b""
+            body = self._conn.scope[BODY_SCOPE_KEY] = await self._conn.body()
+        return body
 
     async def json(self) -> Mapping[str, Any]:
         """Parse the request body as JSON."""
-        return await self._conn.json()
+        if self._json is MISSING:
+            self._json = loads(await self.body())
+        return self._json
 
     async def form(self) -> Mapping[str, str]:
         """Parse the request body as form data."""
@@ -229,17 +258,114 @@ class AuthenticationBackendAdapter(AuthenticationBackend):
     async def authenticate(
         self, request: HTTPConnection
     ) -> tuple[AuthCredentials, BaseUser]:
-        identity = await self._authenticator.authenticate(
-            HttpConnectionAdapter(request, self._store)
-        )  # Call the authenticate method
+        with phase("auth"):
+            identity = await self._authenticator.authenticate(
+                HttpConnectionAdapter(request, self._store)
+            )  # Call the authenticate method
+        return self._result(identity)
+
+    @staticmethod
+    def _result(identity: Identity | None) -> tuple[AuthCredentials, BaseUser]:
         if identity:
             return AuthCredentials(["authenticated"]), User(identity)
         return AuthCredentials(["unauthenticated"]), UnauthenticatedUser()
 
 
+class HttpClientPool:
+    """Server-lifetime httpx client shared by delivery and remote fetches.
+
+    Connections are kept alive between requests and the number of
+    concurrent requests to any single host is capped. Requests made with
+    `request` also feed the shared host health registry. Once closed,
+    the pool can't be used until it is opened again.
+    """
+
+    def __init__(self, config: HttpClientConfig | None = None) -> None:
+        self._config = config or HttpClientConfig()
+        self._client: httpx.AsyncClient | None = None
+        self._closed = False
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        self.health = HostHealthRegistry(self._config.host_health)
+
+    def _create_client(self) -> httpx.AsyncClient:
+        http2 = self._config.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            log.warning("HTTP/2 disabled, the 'h2' package is not installed")
+            http2 = False
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self._config.max_connections,
+                max_keepalive_connections=self._config.max_keepalive_connections,
+                keepalive_expiry=self._config.keepalive_expiry,
+            ),
+            http2=http2,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._closed:
+            raise RuntimeError("HTTP client pool is closed")
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+
+    async def open(self) -> None:
+        self._closed = False
+        if self._client is None or self._client.is_closed:
+            log.debug("Opening HTTP client pool")
+            self._client = self._create_client()
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._client is not None:
+            log.debug("Closing HTTP client pool")
+            await self._client.aclose()
+            self._client = None
+
+    @contextlib.asynccontextmanager
+    async def host_slot(self, url: UrlTypes) -> AsyncIterator[httpx.AsyncClient]:
+        """Wait for a free per-host request slot and yield the shared client."""
+        host = httpx.URL(str(url)).host
+        if (limit := self._host_limits.get(host)) is None:
+            limit = asyncio.Semaphore(self._config.max_connections_per_host)
+            self._host_limits[host] = limit
+        async with limit:
+            yield self.client
+
+    async def request(self, method: str, url: UrlTypes, **kwargs) -> httpx.Response:
+        """Make a request unless the host's circuit is open.
+
+        Transport errors and 5xx responses count as host failures.
+        """
+        host = httpx.URL(str(url)).host
+        if (token := self.health.allow(host)) is None:
+            raise CircuitOpenError(f"Circuit open for {host}")
+        success = False
+        start = time.monotonic()
+        try:
+            async with self.host_slot(url) as client:
+                start = time.monotonic()
+                response = await client.request(method, url, **kwargs)
+                success = response.status_code < 500
+                return response
+        finally:
+            self.health.record(host, success, time.monotonic() - start, token)
+
+
 class HttpxTransport(HttpTransport):
-    def __init__(self, store: ResourceStore):
+    def __init__(self, store: ResourceStore, pool: HttpClientPool | None = None):
         self._store = store
+        self._pool = pool
+
+    async def _request(
+        self, method: str, url: UrlTypes, verify: bool, **kwargs
+    ) -> httpx.Response:
+        # The pooled client always verifies certificates
+        if self._pool is None or not verify:
+            async with httpx.AsyncClient(verify=verify) as client:
+                return await client.request(method, url, **kwargs)
+        return await self._pool.request(method, url, **kwargs)
 
     async def get(
         self,
@@ -257,22 +383,23 @@ class HttpxTransport(HttpTransport):
         timeout: float = DEFAULT_HTTP_TIMEOUT,
         # trust_env: bool = True,
     ) -> HttpResponse:
-        async with httpx.AsyncClient(verify=verify) as client:
-            response = await client.get(
-                url,
-                params=params,
-                headers=headers,
-                cookies=cookies,
-                auth=HttpxAuthAdapter(auth, self._store) if auth else None,
-                follow_redirects=follow_redirects,
-                timeout=timeout,
-            )
-            return HttpResponse(
-                status_code=response.status_code,
-                headers=response.headers,
-                body=response.content,
-                reason_phrase=response.reason_phrase,
-            )
+        response = await self._request(
+            "GET",
+            url,
+            verify,
+            params=params,
+            headers=headers,
+            cookies=cookies,
+            auth=HttpxAuthAdapter(auth, self._store) if auth else None,
+            follow_redirects=follow_redirects,
+            timeout=timeout,
+        )
+        return HttpResponse(
+            status_code=response.status_code,
+            headers=response.headers,
+            body=response.content,
+            reason_phrase=response.reason_phrase,
+        )
 
     async def post(
         self,
@@ -293,22 +420,23 @@ class HttpxTransport(HttpTransport):
         timeout: float = DEFAULT_HTTP_TIMEOUT,
         # trust_env: bool = True,
     ) -> HttpResponse:
-        async with httpx.AsyncClient(verify=verify) as client:
-            response = await client.post(
-                url,
-                json=data,
-                content=content,
-                headers=headers,
-                cookies=cookies,
-                auth=HttpxAuthAdapter(auth, self._store)
-                if auth
-                else httpx.USE_CLIENT_DEFAULT,
-                follow_redirects=follow_redirects,
-                timeout=timeout,
-            )
-            return HttpResponse(
-                status_code=response.status_code,
-                headers=response.headers,
-                body=response.content,
-                reason_phrase=response.reason_phrase,
-            )
+        response = await self._request(
+            "POST",
+            url,
+            verify,
+            json=data,
+            content=content,
+            headers=headers,
+            cookies=cookies,
+            auth=HttpxAuthAdapter(auth, self._store)
+            if auth
+            else httpx.USE_CLIENT_DEFAULT,
+            follow_redirects=follow_redirects,
+            timeout=timeout,
+        )
+        return HttpResponse(
+            status_code=response.status_code,
+            headers=response.headers,
+            body=response.content,
+            reason_phrase=response.reason_phrase,
+        )
@@ -98,7 +98,14 @@ def serve(ctx: Context, verbose: bool, no_banner: bool, **kwargs):
         if verbose:
             logging.root.setLevel(logging.DEBUG)
             logging.debug("DEBUG")
-        run(ctx.store, ctx.config, verbose, kwargs)
+        run(
+            ctx.store,
+            ctx.config,
+            verbose,
+            kwargs,
+            ctx.store_driver.http_pool,
+            ctx.store_driver.delivery_queue,
+        )
     except (asyncio.exceptions.CancelledError, KeyboardInterrupt):
         pass
     except ServerException as ex:
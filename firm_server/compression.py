@@ -0,0 +1,179 @@
+import functools
+import gzip
+import zlib
+from typing import Callable
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from firm_server.conditional import encoded_etag
+from firm_server.config import CompressionConfig
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# In order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+_COMPRESSIBLE_TYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def is_compressible(media_type: str | None) -> bool:
+    if not media_type:
+        return False
+    media_type = media_type.split(";", 1)[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type.endswith(("+json", "+xml"))
+        or media_type in _COMPRESSIBLE_TYPES
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """The preferred supported encoding in an Accept-Encoding value, if any."""
+    qualities: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if (param := params.strip()).startswith("q="):
+            try:
+                quality = float(param[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best = None
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def compress(body: bytes, encoding: str, config: CompressionConfig) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=config.brotli_quality)
+    return gzip.compress(body, compresslevel=config.gzip_level, mtime=0)
+
+
+def _compressor(
+    encoding: str, config: CompressionConfig
+) -> Callable[[bytes, bool], bytes]:
+    """Incremental compression for streamed bodies."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=config.brotli_quality)
+
+        def _br(chunk: bytes, last: bool) -> bytes:
+            data = compressor.process(chunk) if chunk else b""
+            return data + (compressor.finish() if last else compressor.flush())
+
+        return _br
+    compressobj = zlib.compressobj(
+        config.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+    )
+
+    def _gzip(chunk: bytes, last: bool) -> bytes:
+        data = compressobj.compress(chunk)
+        return data + compressobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    return _gzip
+
+
+def add_vary(headers: MutableHeaders, name: str = "Accept-Encoding") -> None:
+    if vary := headers.get("vary"):
+        if name.lower() not in vary.lower():
+            headers["Vary"] = f"{vary}, {name}"
+    else:
+        headers["Vary"] = name
+
+
+def encode_validators(headers: MutableHeaders, accept_encoding: str) -> None:
+    """Give a 304 the ETag and Vary of the compressed 200 it stands for.
+
+    Only for responses that are compressed for clients that accept it.
+    """
+    add_vary(headers)
+    if (etag := headers.get("etag")) and (
+        encoding := negotiate_encoding(accept_encoding)
+    ):
+        headers["ETag"] = encoded_etag(etag, encoding)
+
+
+class CompressionMiddleware:
+    """Compresses responses with the client's preferred encoding.
+
+    Responses that are already encoded (precompressed static files and
+    cached responses), too small, or not of a text-like type are sent
+    unchanged. Streamed responses are compressed incrementally.
+    """
+
+    def __init__(self, app: ASGIApp, config: CompressionConfig) -> None:
+        self.app = app
+        self.config = config
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not (
+            encoding := negotiate_encoding(
+                Headers(scope=scope).get("accept-encoding", "")
+            )
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        start: Message = {}
+        compressor: Callable[[bytes, bool], bytes] | None = None
+        passthrough = False
+
+        async def _send(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start["headers"])
+                if (
+                    "content-encoding" in headers
+                    or not is_compressible(headers.get("content-type"))
+                    or (not more_body and len(body) < self.config.minimum_size)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = encoding
+                if etag := headers.get("etag"):
+                    headers["ETag"] = encoded_etag(etag, encoding)
+                add_vary(headers)
+                if not more_body:
+                    body = compress(body, encoding, self.config)
+                    headers["Content-Length"] = str(len(body))
+                    start["headers"] = headers.raw
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                if "content-length" in headers:
+                    del headers["content-length"]
+                start["headers"] = headers.raw
+                compressor = _compressor(encoding, self.config)
+                await send(start)
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": compressor(body, not more_body),
+                    "more_body": more_body,
+                }
+            )
+
+        await self.app(scope, receive, _send)
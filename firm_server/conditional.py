@@ -0,0 +1,143 @@
+import hashlib
+import time
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping
+
+from firm_server.cache import TtlCache
+
+
+def content_etag(body: bytes) -> str:
+    """A strong ETag for a response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+
+
+@dataclass(frozen=True)
+class ResourceVersion:
+    etag: str
+    # When a change to the resource was last seen, or when it was first
+    # served if no change has been seen, in seconds since the epoch
+    modified: int | None = None
+    # Whether the response is compressed for clients that accept it
+    encodable: bool = False
+
+    @property
+    def last_modified(self) -> str | None:
+        if self.modified is None:
+            return None
+        return formatdate(self.modified, usegmt=True)
+
+
+def _key(uri: str) -> str:
+    return uri.rstrip("/")
+
+
+class ResourceVersions:
+    """Validators of served responses, by resource and response variant.
+
+    ETags are hashes of the response content, so they don't change with
+    restarts or expiry. They're dropped when the store reports a change
+    to the resource, so checking a conditional request needs no read,
+    and the time of the change is kept as its modification time. Until a
+    change is seen (e.g. after a restart) the time the resource was first
+    served is used instead, which is never earlier than its real change.
+    Changes made outside this process are picked up when the validator
+    expires.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 100_000) -> None:
+        # URI -> variant -> version
+        self._versions: TtlCache[str, dict[str, ResourceVersion]] = TtlCache(
+            ttl, max_size
+        )
+        self._modified: TtlCache[str, int] = TtlCache(ttl, max_size)
+        # URI -> token of the latest pending response
+        self._pending: dict[str, object] = {}
+
+    def find(self, uri: str, variant: str = "") -> ResourceVersion | None:
+        return self._versions.get(_key(uri), {}).get(variant)
+
+    def begin(self, uri: str) -> object:
+        """Start computing a response, returning a token for `put` or `abort`."""
+        token = self._pending[_key(uri)] = object()
+        return token
+
+    def put(
+        self,
+        token: object,
+        uri: str,
+        variant: str,
+        body: bytes,
+        etag: str | None = None,
+        encodable: bool = False,
+    ) -> ResourceVersion:
+        """The version of a response, kept unless the resource changed meanwhile.
+
+        The ETag is a hash of the body unless one is given.
+        """
+        uri = _key(uri)
+        if (modified := self._modified.get(uri)) is None:
+            modified = int(time.time())
+        version = ResourceVersion(etag or content_etag(body), modified, encodable)
+        if self._pending.get(uri) is token:
+            del self._pending[uri]
+            self._modified.set(uri, modified)
+            if (variants := self._versions.get(uri)) is None:
+                variants = {}
+                self._versions.set(uri, variants)
+            variants[variant] = version
+        return version
+
+    def abort(self, token: object, uri: str) -> None:
+        if self._pending.get(uri := _key(uri)) is token:
+            del self._pending[uri]
+
+    def changed(self, uri: str) -> None:
+        uri = _key(uri)
+        self._versions.pop(uri)
+        self._pending.pop(uri, None)
+        self._modified.set(uri, int(time.time()))
+
+
+def _parse_http_date(value: str) -> float | None:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+# Content codings that are added to ETags of encoded responses
+_CODINGS = ("br", "gzip")
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """The ETag of a content-encoded response, e.g. "abc" -> "abc-gzip"."""
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else etag
+
+
+def unencoded_etag(etag: str) -> str:
+    for coding in _CODINGS:
+        if etag.endswith(suffix := f'-{coding}"'):
+            return etag[: -len(suffix)] + '"'
+    return etag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison, treating encoded variants as the same content."""
+    tags = [
+        unencoded_etag(tag.strip().removeprefix("W/"))
+        for tag in if_none_match.split(",")
+    ]
+    return unencoded_etag(etag) in tags or "*" in tags
+
+
+def is_not_modified(
+    headers: Mapping[str, str], etag: str, modified: int | None = None
+) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when it's absent."""
+    if if_none_match := headers.get("if-none-match"):
+        return etag_matches(if_none_match, etag)
+    if if_modified_since := headers.get("if-modified-since"):
+        since = _parse_http_date(if_modified_since)
+        return modified is not None and since is not None and modified <= since
+    return False
@@ -13,6 +13,7 @@ class FileStoreConfig:
     remote_subdir: str = "remote"
     tenants_subdir: str = "tenants"
     private_subdir: str = "private"
+    queue_subdir: str = "queue"
 
 
 @dataclass(frozen=True)
@@ -33,11 +34,151 @@ class ValidationConfig:
     package_names: list[str] = field(default_factory=list)
 
 
+@dataclass(frozen=True)
+class HostHealthConfig:
+    failure_threshold: int = 5
+    reset_timeout: float = 60.0
+    max_reset_timeout: float = 60 * 60
+
+
+@dataclass(frozen=True)
+class HttpClientConfig:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    max_connections_per_host: int = 10
+    keepalive_expiry: float = 30.0
+    http2: bool = False
+    host_health: HostHealthConfig = HostHealthConfig()
+
+
+@dataclass(frozen=True)
+class DeliveryConfig:
+    concurrent: bool = True
+    max_concurrency: int = 32
+    # At most http_client.max_connections_per_host
+    max_concurrency_per_host: int = 4
+    # Per request, not including waiting for a free slot
+    timeout: float = 10.0
+    workers: int = 4
+    # Defaults to a subdirectory of the filesystem store. The rdf store has
+    # no default, so without it pending deliveries are only kept in memory
+    # and are lost on shutdown.
+    queue_path: str | None = None
+    max_attempts: int = 10
+    backoff_base: float = 30.0
+    backoff_max: float = 6 * 60 * 60
+    max_age: float = 3 * 24 * 60 * 60
+    resolve_concurrency: int = 16
+    recipient_cache_ttl: float = 60 * 60
+    max_collection_depth: int = 2
+    max_recipients: int = 10_000
+
+
+@dataclass(frozen=True)
+class PublicKeyCacheConfig:
+    ttl: float = 60 * 60
+    # Unresolvable keys
+    negative_ttl: float = 5 * 60
+    # Minimum age of a cached key before a failed verification refetches it
+    min_refresh_interval: float = 60.0
+    max_size: int = 10_000
+
+
+@dataclass(frozen=True)
+class RequestConfig:
+    # Larger request bodies are rejected with 413
+    max_body_size: int = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class CompressionConfig:
+    enabled: bool = True
+    # Smaller responses are sent uncompressed
+    minimum_size: int = 500
+    gzip_level: int = 6
+    # Used when the brotli package is installed
+    brotli_quality: int = 4
+
+
+@dataclass(frozen=True)
+class StaticFilesConfig:
+    # Smaller files are held in memory
+    memory_max_file_size: int = 256 * 1024
+    # Cache-Control max-age for static URLs without a fingerprint
+    max_age: int = 60 * 60
+    # Fingerprinted URLs change with the content, so they're cached for a year
+    fingerprinted_max_age: int = 365 * 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class TemplatesConfig:
+    # Compiled templates are kept on disk across restarts
+    bytecode_cache: bool = True
+    # Defaults to a per-user temporary directory
+    bytecode_cache_dir: str | None = None
+    # Compile every template at startup instead of on first use
+    precompile: bool = False
+    # Send pages as they're rendered, starting with the document head
+    streaming: bool = False
+    stream_chunk_size: int = 16 * 1024
+
+
+@dataclass(frozen=True)
+class PagingConfig:
+    # Larger collections are served as pages (0 disables paging)
+    page_size: int = 50
+
+
+@dataclass(frozen=True)
+class HttpCachingConfig:
+    # ETag and Last-Modified validators for ActivityPub GETs
+    conditional_get: bool = True
+    # Bounds staleness from changes made outside the server process
+    validator_ttl: float = 10 * 60
+    # Encoded anonymous ActivityPub GET responses
+    response_cache: bool = True
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    response_cache_ttl: float = 10 * 60
+    # Rendered HTML pages of stored resources
+    page_cache: bool = True
+    page_cache_max_bytes: int = 32 * 1024 * 1024
+    page_cache_ttl: float = 10 * 60
+
+
+@dataclass(frozen=True)
+class TimingConfig:
+    # Send request phase timings to clients
+    server_timing_header: bool = False
+    # Slower requests are logged with their phase timings
+    slow_request_threshold: float = 1.0
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    # Served at /metrics, only to allowed client addresses. They're
+    # checked against the connection's peer, not proxy headers, so a
+    # reverse proxy's address allows everyone behind it. For other clients
+    # the path is handled as usual.
+    enabled: bool = False
+    allowed_clients: list[str] = field(default_factory=lambda: ["127.0.0.1", "::1"])
+
+
 @dataclass
 class ServerConfig:
     tenants: list[str]
     store: StoreDriverConfigs
     validation: ValidationConfig = ValidationConfig()
+    http_client: HttpClientConfig = HttpClientConfig()
+    delivery: DeliveryConfig = DeliveryConfig()
+    public_key_cache: PublicKeyCacheConfig = PublicKeyCacheConfig()
+    caching: HttpCachingConfig = HttpCachingConfig()
+    paging: PagingConfig = PagingConfig()
+    request: RequestConfig = RequestConfig()
+    compression: CompressionConfig = CompressionConfig()
+    static: StaticFilesConfig = StaticFilesConfig()
+    templates: TemplatesConfig = TemplatesConfig()
+    timing: TimingConfig = TimingConfig()
+    metrics: MetricsConfig = MetricsConfig()
 
     def is_local(self, uri: str) -> bool:
         return any(uri.startswith(tenant) for tenant in self.tenants)
@@ -0,0 +1,477 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Coroutine, Iterable
+
+import httpx
+from firm.auth.http_signature import HttpSignatureAuth
+from firm.interfaces import (
+    DeliveryService,
+    HttpException,
+    JSONObject,
+    ResourceStore,
+)
+from firm.util import AP_PUBLIC_URIS
+
+from firm_server.adapters import HttpClientPool, HttpxAuthAdapter
+from firm_server.cache import MISSING, TtlCache
+from firm_server.config import ServerConfig
+from firm_server.delivery_queue import DeliveryJob, DeliveryQueue, InboxDelivery
+from firm_server.encoding import dumps
+from firm_server.health import CircuitOpenError
+from firm_server.keys import SigningKeyCache
+from firm_server.metrics import REGISTRY
+from firm_server.store import ObservableStore, append_to_collection
+from firm_server.timing import phase
+
+log = logging.getLogger(__name__)
+
+# The status of a POST that wasn't made because the host's circuit was open
+NOT_ATTEMPTED = 0
+
+ACTIVITIES = REGISTRY.counter(
+    "firm_delivery_activities_total", "Activities planned for delivery"
+)
+RECIPIENTS = REGISTRY.counter(
+    "firm_delivery_recipients_total", "Remote recipients of planned deliveries"
+)
+PLANNED_POSTS = REGISTRY.counter(
+    "firm_delivery_planned_posts_total", "Inbox POSTs planned for delivery"
+)
+POSTS_SAVED = REGISTRY.counter(
+    "firm_delivery_posts_saved_total", "Inbox POSTs saved by shared inboxes"
+)
+IN_FLIGHT = REGISTRY.gauge("firm_delivery_in_flight", "Inbox POSTs in progress")
+LATENCY = REGISTRY.histogram(
+    "firm_delivery_latency_seconds", "Inbox POST latency", ["host"]
+)
+RESPONSES = REGISTRY.counter(
+    "firm_delivery_responses_total", "Inbox POST outcomes", ["host", "status"]
+)
+BYTES_SENT = REGISTRY.counter(
+    "firm_delivery_bytes_sent_total", "Payload bytes POSTed to inboxes", ["host"]
+)
+RETRIES = REGISTRY.counter(
+    "firm_delivery_retries_total", "Inbox deliveries scheduled for a retry"
+)
+FAILURES = REGISTRY.counter(
+    "firm_delivery_failures_total", "Inbox deliveries abandoned", ["reason"]
+)
+
+
+# TODO Move to util
+def is_collection(obj: JSONObject) -> bool:
+    return obj.get("type") in ["Collection", "OrderedCollection"]
+
+
+def is_local(prefix: str, uri: str):
+    return uri.startswith(prefix)
+
+
+def is_public(uri: str):
+    return uri in AP_PUBLIC_URIS
+
+
+@dataclass(frozen=True)
+class Recipient:
+    inbox: str
+    shared_inbox: str | None = None
+
+
+@dataclass
+class DeliveryPlan:
+    """Remote inboxes grouped by host, hosts with the most recipients first."""
+
+    hosts: dict[str, list[str]]
+    recipients: int
+
+    @property
+    def inboxes(self) -> list[str]:
+        return [inbox for inboxes in self.hosts.values() for inbox in inboxes]
+
+    @property
+    def posts_saved(self) -> int:
+        return self.recipients - len(self.inboxes)
+
+
+def plan_delivery(recipients: Iterable[Recipient]) -> DeliveryPlan:
+    """Collapse recipients onto their shared inboxes, one POST per inbox."""
+    by_host: dict[str, list[Recipient]] = {}
+    for recipient in recipients:
+        inbox = recipient.shared_inbox or recipient.inbox
+        by_host.setdefault(httpx.URL(inbox).host, []).append(recipient)
+    hosts = {}
+    for host, host_recipients in sorted(
+        by_host.items(), key=lambda item: (-len(item[1]), item[0])
+    ):
+        hosts[host] = list(
+            dict.fromkeys(r.shared_inbox or r.inbox for r in host_recipients)
+        )
+    return DeliveryPlan(hosts, sum(len(r) for r in by_host.values()))
+
+
+def _strip_private(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            k: _strip_private(v)
+            for k, v in value.items()
+            if not k.startswith("firm:") and k not in ("bto", "bcc")
+        }
+    if isinstance(value, list):
+        return [_strip_private(v) for v in value]
+    return value
+
+
+@dataclass(frozen=True)
+class DeliveryPayload:
+    """An activity encoded once and shared by every recipient POST."""
+
+    body: bytes
+    digest: str
+
+    @classmethod
+    def from_activity(cls, activity: JSONObject) -> "DeliveryPayload":
+        # TODO message specific serialization
+        # (selected object embedding, collection paging, etc.)
+        body = dumps(_strip_private(activity))
+        digest = base64.b64encode(hashlib.sha256(body).digest()).decode()
+        return cls(body, f"SHA-256={digest}")
+
+
+# TODO Reconsider design of FirmDeliveryService (abstract class?)
+class FirmDeliveryService(DeliveryService):
+    _RECIPIENT_PROPS = ("to", "cc", "bto", "bcc")
+
+    def __init__(
+        self,
+        config: ServerConfig,
+        store: ResourceStore,
+        http_pool: HttpClientPool,
+        queue: DeliveryQueue,
+    ):
+        self._config = config
+        self._store = store
+        self._http_pool = http_pool
+        self._queue = queue
+        self._signing_keys = SigningKeyCache(store)
+        if isinstance(store, ObservableStore):
+            store.add_listener(self._signing_keys.changed)
+        # Shared by all deliveries so the caps are global
+        self._limit = asyncio.Semaphore(config.delivery.max_concurrency)
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        REGISTRY.gauge(
+            "firm_delivery_queue_depth",
+            "Activities with pending deliveries",
+            function=lambda: len(queue),
+        )
+        self._recipient_cache: TtlCache[str, Recipient | None] = TtlCache(
+            config.delivery.recipient_cache_ttl
+        )
+
+    @staticmethod
+    def _recipient(obj: JSONObject) -> Recipient | None:
+        if inbox := obj.get("inbox"):
+            endpoints = obj.get("endpoints")
+            shared_inbox = obj.get("sharedInbox") or (
+                endpoints.get("sharedInbox") if isinstance(endpoints, dict) else None
+            )
+            return Recipient(inbox, shared_inbox)
+        return None
+
+    async def _get_recipient_object(
+        self, uri: str, limit: asyncio.Semaphore
+    ) -> JSONObject | None:
+        async with limit:
+            try:
+                return await self._store.get(uri)
+            except (httpx.HTTPError, HttpException, ValueError) as e:
+                # Failed fetches of remote recipients, or unparseable documents
+                log.warning("Unable to resolve recipient %s: %r", uri, e)
+                return None
+
+    async def _resolve_recipients(
+        self, recipient_uris: Iterable[str]
+    ) -> dict[str, Recipient]:
+        """Map each addressed actor, including collection members, to its inboxes.
+
+        Each level of collection nesting is fetched as one concurrent batch.
+        Actor inboxes are cached, collection membership is always reread.
+        """
+        config = self._config.delivery
+        limit = asyncio.Semaphore(config.resolve_concurrency)
+        recipients: dict[str, Recipient] = {}
+        seen: set[str] = set()
+        level = [uri for uri in recipient_uris if not is_public(uri)]
+        for _ in range(config.max_collection_depth + 1):
+            uris = [uri for uri in dict.fromkeys(level) if uri not in seen]
+            seen.update(uris)
+            fetch_uris = []
+            for uri in uris:
+                cached = self._recipient_cache.get(uri, MISSING)
+                if cached is MISSING:
+                    fetch_uris.append(uri)
+                elif cached:
+                    recipients[uri] = cached
+            objs = await asyncio.gather(
+                *(self._get_recipient_object(uri, limit) for uri in fetch_uris)
+            )
+            level = []
+            for uri, obj in zip(fetch_uris, objs):
+                if not obj:
+                    continue
+                if is_collection(obj):  # TODO and self._store.is_local(uri):
+                    for item in obj.get("items") or obj.get("orderedItems") or []:
+                        if isinstance(item, dict):
+                            item = item.get("id")
+                        if isinstance(item, str) and not is_public(item):
+                            level.append(item)
+                else:
+                    recipient = self._recipient(obj)
+                    self._recipient_cache.set(uri, recipient)
+                    if recipient:
+                        recipients[uri] = recipient
+            if len(recipients) + len(level) > config.max_recipients:
+                log.warning("Recipients truncated to %d", config.max_recipients)
+                level = level[: max(config.max_recipients - len(recipients), 0)]
+            if not level:
+                break
+        else:
+            log.warning(
+                "Ignored %d recipients in collections nested deeper than %d",
+                len(level),
+                config.max_collection_depth,
+            )
+        return recipients
+
+    async def _post(
+        self,
+        inbox: str,
+        /,
+        message: DeliveryPayload,
+        auth: HttpSignatureAuth,
+    ) -> int:
+        response = await self._http_pool.request(
+            "POST",
+            inbox,
+            content=message.body,
+            headers={
+                "Content-Type": "application/activity+json",
+                "Digest": message.digest,
+            },
+            auth=HttpxAuthAdapter(auth, self._store),
+            timeout=self._config.delivery.timeout,
+        )
+        log.debug("FirmDeliveryService POST %s %s", inbox, response.status_code)
+        return response.status_code
+
+    def _host_limit(self, inbox: str) -> asyncio.Semaphore:
+        """The delivery share of a host's request slots in the HTTP pool.
+
+        It's capped at the pool's per-host limit, so deliveries only wait
+        for a pool slot when other requests to the host are using it.
+        """
+        host = httpx.URL(inbox).host
+        if (limit := self._host_limits.get(host)) is None:
+            limit = asyncio.Semaphore(
+                min(
+                    self._config.delivery.max_concurrency_per_host,
+                    self._config.http_client.max_connections_per_host,
+                )
+            )
+            self._host_limits[host] = limit
+        return limit
+
+    async def _post_bounded(
+        self,
+        inbox: str,
+        /,
+        message: DeliveryPayload,
+        auth: HttpSignatureAuth,
+    ) -> int | None:
+        host = httpx.URL(inbox).host
+        if self._http_pool.health.is_open(host):
+            RESPONSES.inc(host=host, status="not_attempted")
+            return NOT_ATTEMPTED
+        status = None
+        # A global slot is only taken once the host has a free slot, so
+        # deliveries queued for a slow host don't hold up other hosts.
+        # The request's own timeout doesn't include waiting for slots.
+        async with self._host_limit(inbox), self._limit:
+            IN_FLIGHT.inc()
+            start = time.monotonic()
+            try:
+                status = await self._post(inbox, message=message, auth=auth)
+            except CircuitOpenError:
+                # Another request is probing the host
+                RESPONSES.inc(host=host, status="not_attempted")
+                return NOT_ATTEMPTED
+            except httpx.HTTPError as e:
+                log.warning("FirmDeliveryService POST %s failed: %r", inbox, e)
+            finally:
+                IN_FLIGHT.dec()
+            LATENCY.observe(time.monotonic() - start, host=host)
+            RESPONSES.inc(host=host, status=str(status or "error"))
+        if status is not None:
+            BYTES_SENT.inc(len(message.body), host=host)
+        return status
+
+    async def _post_all(
+        self,
+        inboxes: Iterable[str],
+        message: DeliveryPayload,
+        auth: HttpSignatureAuth,
+    ) -> dict[str, int | None]:
+        """POST the message to each inbox and return the status of each.
+
+        The status is None when no response was received, and
+        `NOT_ATTEMPTED` when the host's circuit was open.
+        """
+        if not self._config.delivery.concurrent:
+            return {
+                inbox: await self._post_bounded(inbox, message=message, auth=auth)
+                for inbox in inboxes
+            }
+        inboxes = list(inboxes)
+        results = await asyncio.gather(
+            *(
+                self._post_bounded(inbox, message=message, auth=auth)
+                for inbox in inboxes
+            )
+        )
+        return dict(zip(inboxes, results))
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(
+            self._config.delivery.backoff_base * 2 ** (attempts - 1),
+            self._config.delivery.backoff_max,
+        )
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _is_retryable(status: int | None) -> bool:
+        return status is None or status >= 500 or status in (408, 429)
+
+    async def _deliver_local(self, inbox_uri: str, activity_uri: str) -> None:
+        # unique: redelivery after a restart
+        await append_to_collection(self._store, inbox_uri, activity_uri, unique=True)
+
+    async def _resolve_job(self, job: DeliveryJob) -> None:
+        activity = job.activity
+        recipient_uris: set[str] = set()
+        for prop in self._RECIPIENT_PROPS:
+            if r := activity.get(prop):
+                if isinstance(r, str):
+                    recipient_uris.add(r)
+                elif isinstance(r, list):
+                    recipient_uris.update(r)
+        recipients = await self._resolve_recipients(recipient_uris)
+        remote_recipients = []
+        for recipient in recipients.values():
+            # Local recipients always get their own inbox, never a shared one
+            if self._config.is_local(recipient.inbox):
+                await self._deliver_local(recipient.inbox, activity["id"])
+            else:
+                remote_recipients.append(recipient)
+        plan = plan_delivery(remote_recipients)
+        ACTIVITIES.inc()
+        RECIPIENTS.inc(plan.recipients)
+        PLANNED_POSTS.inc(len(plan.inboxes))
+        POSTS_SAVED.inc(plan.posts_saved)
+        log.info(
+            "Delivery plan for %s: %d recipients, %d hosts, %d POSTs (%d saved)",
+            activity["id"],
+            plan.recipients,
+            len(plan.hosts),
+            len(plan.inboxes),
+            plan.posts_saved,
+        )
+        job.inboxes = {inbox: InboxDelivery() for inbox in plan.inboxes}
+
+    async def _process(self, job: DeliveryJob) -> None:
+        """Make one delivery attempt for each due inbox of a leased job."""
+        now = time.time()
+        if now - job.created > self._config.delivery.max_age:
+            log.error(
+                "Delivery of %s expired, %d inboxes not delivered",
+                job.activity["id"],
+                len(job.inboxes or []),
+            )
+            FAILURES.inc(len(job.inboxes or []), reason="expired")
+            await self._queue.remove(job.id)
+            return
+        auth = await self._signing_keys.get(job.activity["actor"])
+        if auth is None:
+            await self._queue.remove(job.id)
+            return
+        if job.inboxes is None:
+            await self._resolve_job(job)
+        due = []
+        health = self._http_pool.health
+        for inbox, delivery in job.inboxes.items():
+            if delivery.next_attempt > now:
+                continue
+            host = httpx.URL(inbox).host
+            if health.is_open(host):
+                # Not an attempt, wait for the circuit to be probed
+                delivery.next_attempt = now + health.retry_after(host)
+            else:
+                due.append(inbox)
+        if due:
+            message = DeliveryPayload.from_activity(job.activity)
+            results = await self._post_all(due, message, auth)
+            for inbox, status in results.items():
+                delivery = job.inboxes[inbox]
+                if status == NOT_ATTEMPTED:
+                    host = httpx.URL(inbox).host
+                    delivery.next_attempt = time.time() + health.retry_after(host)
+                    continue
+                delivery.attempts += 1
+                if status is not None and 200 <= status < 300:
+                    del job.inboxes[inbox]
+                elif not self._is_retryable(status):
+                    log.error("Delivery to %s rejected: %s", inbox, status)
+                    FAILURES.inc(reason="rejected")
+                    del job.inboxes[inbox]
+                elif delivery.attempts >= self._config.delivery.max_attempts:
+                    log.error("Delivery to %s failed, giving up", inbox)
+                    FAILURES.inc(reason="max_attempts")
+                    del job.inboxes[inbox]
+                else:
+                    RETRIES.inc()
+                    delivery.last_error = str(status)
+                    delivery.next_attempt = time.time() + self._backoff(
+                        delivery.attempts
+                    )
+        if job.inboxes:
+            job.schedule()
+            await self._queue.put(job)
+        else:
+            await self._queue.remove(job.id)
+
+    async def _worker(self, name: str) -> None:
+        log.info("Delivery worker %s started", name)
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Delivery of %s failed", job.activity.get("id"))
+                job.attempts += 1
+                job.next_attempt = time.time() + self._backoff(job.attempts)
+                await self._queue.put(job)
+
+    def workers(self) -> list[Coroutine]:
+        """Worker coroutines that drain the delivery queue."""
+        return [
+            self._worker(f"delivery-{i}") for i in range(self._config.delivery.workers)
+        ]
+
+    async def deliver(self, activity: JSONObject) -> None:
+        with phase("delivery"):
+            await self._queue.put(DeliveryJob(activity))
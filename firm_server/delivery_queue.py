@@ -0,0 +1,201 @@
+import asyncio
+import dataclasses
+import heapq
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+import dacite
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class InboxDelivery:
+    attempts: int = 0
+    next_attempt: float = 0.0
+    last_error: str | None = None
+
+
+@dataclass
+class DeliveryJob:
+    activity: dict[str, Any]
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    created: float = field(default_factory=time.time)
+    # Remote inboxes still to be delivered, None until recipients are resolved
+    inboxes: dict[str, InboxDelivery] | None = None
+    attempts: int = 0
+    next_attempt: float = 0.0
+
+    def schedule(self) -> None:
+        """Set the next attempt time from the earliest pending inbox."""
+        if self.inboxes:
+            self.next_attempt = min(d.next_attempt for d in self.inboxes.values())
+
+
+class DeliveryQueue:
+    """Schedules delivery jobs by their next attempt time.
+
+    Jobs handed out by `get` are leased to the caller until they are
+    either `put` back (rescheduled) or `remove`d. Subclasses persist jobs
+    so pending deliveries survive a restart.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: dict[str, DeliveryJob] = {}
+        self._heap: list[tuple[float, int, str]] = []
+        self._scheduled: dict[str, int] = {}
+        self._leased: set[str] = set()
+        self._seq = 0
+        self._changed: asyncio.Condition | None = None
+        self._opening: asyncio.Lock | None = None
+        self._opened = False
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    @property
+    def leased(self) -> int:
+        return len(self._leased)
+
+    def _condition(self) -> asyncio.Condition:
+        # Created lazily so the condition binds to the running loop
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    async def _load(self) -> Iterable[DeliveryJob]:
+        return []
+
+    async def _save(self, job: DeliveryJob) -> None:
+        ...
+
+    async def _delete(self, job_id: str) -> None:
+        ...
+
+    def _schedule(self, job: DeliveryJob) -> None:
+        self._seq += 1
+        self._scheduled[job.id] = self._seq
+        heapq.heappush(self._heap, (job.next_attempt, self._seq, job.id))
+
+    async def open(self) -> None:
+        """Load persisted jobs. Jobs leased before a restart are pending again."""
+        if self._opened:
+            return
+        if self._opening is None:
+            self._opening = asyncio.Lock()
+        async with self._opening:
+            if self._opened:
+                return
+            for job in await self._load():
+                self._jobs[job.id] = job
+                self._schedule(job)
+            self._opened = True
+        if self._jobs:
+            log.info("Recovered %d pending delivery jobs", len(self._jobs))
+
+    async def put(self, job: DeliveryJob) -> None:
+        """Store a new or updated job and release any lease on it."""
+        await self.open()
+        await self._save(job)
+        self._jobs[job.id] = job
+        self._leased.discard(job.id)
+        self._schedule(job)
+        condition = self._condition()
+        async with condition:
+            condition.notify()
+
+    async def remove(self, job_id: str) -> None:
+        await self._delete(job_id)
+        self._jobs.pop(job_id, None)
+        self._scheduled.pop(job_id, None)
+        self._leased.discard(job_id)
+
+    def _pop_due(self, now: float) -> DeliveryJob | float | None:
+        """Lease the next due job, or return the time until one is due."""
+        while self._heap:
+            due, seq, job_id = self._heap[0]
+            if self._scheduled.get(job_id) != seq or job_id in self._leased:
+                # superseded by a later schedule or already handed out
+                heapq.heappop(self._heap)
+                continue
+            if due > now:
+                return due - now
+            heapq.heappop(self._heap)
+            del self._scheduled[job_id]
+            self._leased.add(job_id)
+            return self._jobs[job_id]
+        return None
+
+    async def get(self) -> DeliveryJob:
+        """Wait until a job is due and lease it to the caller."""
+        await self.open()
+        condition = self._condition()
+        async with condition:
+            while True:
+                result = self._pop_due(time.time())
+                if isinstance(result, DeliveryJob):
+                    return result
+                try:
+                    await asyncio.wait_for(condition.wait(), result)
+                except TimeoutError:
+                    pass
+
+
+class MemoryDeliveryQueue(DeliveryQueue):
+    """Non-durable queue, pending deliveries are lost on shutdown."""
+
+
+class FileDeliveryQueue(DeliveryQueue):
+    """Persists each job as a JSON file in a directory.
+
+    File operations run in worker threads so they don't block the event loop.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._path = path
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self._path, f"{job_id}.json")
+
+    def _read_jobs(self) -> list[DeliveryJob]:
+        os.makedirs(self._path, exist_ok=True)
+        jobs = []
+        for filename in os.listdir(self._path):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self._path, filename)) as f:
+                    jobs.append(
+                        dacite.from_dict(data_class=DeliveryJob, data=json.load(f))
+                    )
+            except (OSError, ValueError, dacite.exceptions.DaciteError) as e:
+                log.error("Unreadable delivery job %s: %s", filename, e)
+        return jobs
+
+    def _write_job(self, job: dict[str, Any]) -> None:
+        path = self._job_path(job["id"])
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(job, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _remove_job(self, job_id: str) -> None:
+        try:
+            os.remove(self._job_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    async def _load(self) -> Iterable[DeliveryJob]:
+        return await asyncio.to_thread(self._read_jobs)
+
+    async def _save(self, job: DeliveryJob) -> None:
+        # Copied here, the job may change while it's written
+        await asyncio.to_thread(self._write_job, dataclasses.asdict(job))
+
+    async def _delete(self, job_id: str) -> None:
+        await asyncio.to_thread(self._remove_job, job_id)
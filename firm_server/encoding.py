@@ -0,0 +1,47 @@
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _orjson_dumps(content: Any) -> bytes:
+    try:
+        return orjson.dumps(content)
+    except TypeError:
+        # e.g. non-string keys or integers outside the 64-bit range
+        return _stdlib_dumps(content)
+
+
+def _stdlib_dumps(content: Any) -> bytes:
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+dumps = _orjson_dumps if orjson is not None else _stdlib_dumps
+"""Encode compact UTF-8 JSON, with orjson when it's installed."""
+
+loads = orjson.loads if orjson is not None else json.loads
+"""Decode JSON from bytes or str, with orjson when it's installed."""
+
+
+class JSONResponse(StarletteJSONResponse):
+    """A JSON response encoded with `dumps`.
+
+    The content may also be already encoded JSON (bytes), which is
+    sent as is.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,157 @@
+import enum
+import logging
+import time
+from dataclasses import dataclass
+
+import httpx
+
+from firm_server.config import HostHealthConfig
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of contacting a host whose circuit is open."""
+
+
+# The token for requests that aren't probes
+_REQUEST = object()
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+@dataclass
+class HostHealth:
+    host: str
+    consecutive_failures: int = 0
+    # Exponentially weighted moving average, in seconds
+    latency: float | None = None
+    opened_at: float | None = None
+    reset_timeout: float = 0.0
+    # The probe request in flight while half-open
+    probe: object | None = None
+
+    @property
+    def probing(self) -> bool:
+        return self.probe is not None
+
+    def state(self, now: float) -> CircuitState:
+        if self.opened_at is None:
+            return CircuitState.CLOSED
+        if self.probing or now - self.opened_at >= self.reset_timeout:
+            return CircuitState.HALF_OPEN
+        return CircuitState.OPEN
+
+
+class HostHealthRegistry:
+    """Tracks remote host health and opens a circuit for failing hosts.
+
+    After `failure_threshold` consecutive failures requests to a host
+    fail fast until `reset_timeout` has passed. Then a single probe
+    request is let through, closing the circuit if it succeeds and
+    reopening it with a doubled timeout if it fails.
+    """
+
+    _LATENCY_WEIGHT = 0.2
+    # Seconds to wait for a probe that is in flight
+    _PROBE_WAIT = 1.0
+
+    def __init__(self, config: HostHealthConfig | None = None) -> None:
+        self._config = config or HostHealthConfig()
+        self._hosts: dict[str, HostHealth] = {}
+
+    def __getitem__(self, host: str) -> HostHealth:
+        if (health := self._hosts.get(host)) is None:
+            health = self._hosts[host] = HostHealth(host)
+        return health
+
+    @property
+    def hosts(self) -> list[HostHealth]:
+        return list(self._hosts.values())
+
+    def is_open(self, host: str) -> bool:
+        """True while requests to the host must not be attempted.
+
+        That includes a half-open host that is already being probed.
+        """
+        health = self._hosts.get(host)
+        if health is None:
+            return False
+        state = health.state(time.monotonic())
+        return state == CircuitState.OPEN or (
+            state == CircuitState.HALF_OPEN and health.probing
+        )
+
+    def retry_after(self, host: str) -> float:
+        """Seconds until the host's circuit may be probed again."""
+        health = self._hosts.get(host)
+        if health is None or health.opened_at is None:
+            return 0.0
+        if health.probing:
+            return self._PROBE_WAIT
+        return max(health.opened_at + health.reset_timeout - time.monotonic(), 0.0)
+
+    def allow(self, host: str) -> object | None:
+        """Check whether a request may be made, claiming the probe if half-open.
+
+        Returns None if it may not, otherwise a token to pass to `record`
+        with the request's outcome.
+        """
+        health = self._hosts.get(host)
+        if health is None:
+            return _REQUEST
+        state = health.state(time.monotonic())
+        if state == CircuitState.CLOSED:
+            return _REQUEST
+        if state == CircuitState.HALF_OPEN and not health.probing:
+            health.probe = object()
+            return health.probe
+        return None
+
+    def record(
+        self, host: str, success: bool, latency: float, token: object = None
+    ) -> None:
+        """Record a request's outcome.
+
+        Only the probe's outcome (with the token `allow` returned for it)
+        decides whether a half-open circuit closes or reopens, though any
+        success closes it.
+        """
+        health = self[host]
+        probe = token is not None and token is health.probe
+        health.latency = (
+            latency
+            if health.latency is None
+            else health.latency + self._LATENCY_WEIGHT * (latency - health.latency)
+        )
+        if success:
+            if health.opened_at is not None:
+                log.info("Circuit closed for %s", host)
+            health.consecutive_failures = 0
+            health.opened_at = None
+            health.reset_timeout = 0.0
+        else:
+            health.consecutive_failures += 1
+            if probe:
+                health.reset_timeout = min(
+                    health.reset_timeout * 2, self._config.max_reset_timeout
+                )
+                health.opened_at = time.monotonic()
+                log.warning("Circuit reopened for %s", host)
+            elif (
+                health.opened_at is None
+                and health.consecutive_failures >= self._config.failure_threshold
+            ):
+                health.reset_timeout = self._config.reset_timeout
+                health.opened_at = time.monotonic()
+                log.warning(
+                    "Circuit opened for %s after %d failures",
+                    host,
+                    health.consecutive_failures,
+                )
+        if probe or success:
+            health.probe = None
@@ -1,10 +1,19 @@
 import logging
-import mimetypes
 import os
+import time
 from dataclasses import dataclass
-from typing import Any, Awaitable, Callable
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+)
 from urllib.parse import urlparse
 
+import jinja2
 from firm.interfaces import (
     FIRM_NS,
     HttpRequest,
@@ -14,69 +23,75 @@ from firm.interfaces import (
 )
 from firm.util import get_version
 from starlette.requests import Request
-from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.responses import (
+    FileResponse,
+    HTMLResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.templating import Jinja2Templates
 
-from firm_server.config import ServerConfig
+from firm_server.compression import encode_validators, negotiate_encoding
+from firm_server.conditional import encoded_etag, etag_matches
+from firm_server.config import ServerConfig, TemplatesConfig
+from firm_server.encoding import JSONResponse
+from firm_server.html.page_cache import LOOKUPS, PageCache
+from firm_server.html.static import StaticManifest
+from firm_server.html.timeline import ActorTimelines
+from firm_server.response_cache import cached_response, is_encodable
+from firm_server.store import ObservableStore
+from firm_server.timing import phase
 
 log = logging.getLogger(__name__)
 
-STATIC_DIR = "firm_server/html/static"
 
-
-def html_static_endpoint(config: ServerConfig):
-    tenant_static_dirs = {}
-    for tenant in config.tenants:
-        prefix = urlparse(tenant)
-        static_dir = os.path.join(
-            "firm_server/html/tenants", prefix.hostname or "", "static"
-        )
-        tenant_static_dirs[tenant] = (
-            [static_dir, STATIC_DIR] if os.path.exists(static_dir) else [STATIC_DIR]
-        )
+def html_static_endpoint(config: ServerConfig, manifest: StaticManifest | None = None):
+    manifest = manifest or StaticManifest(config)
 
     async def _static_endpoint(request: Request):
         prefix = get_url_prefix(str(request.url))
-        if static_dirs := tenant_static_dirs.get(prefix):
-            request_file_path = request.path_params["file_path"]
-            for static_dir in static_dirs:
-                file_path = os.path.join(static_dir, request_file_path)
-                if os.path.exists(file_path):
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    mime_type = mime_type or "application/octet-stream"
-                    return FileResponse(file_path, media_type=mime_type)
-        return Response("File not found", status_code=404)
+        found = manifest.find(prefix, request.path_params["file_path"])
+        if found is None:
+            return Response("File not found", status_code=404)
+        asset, fingerprinted = found
+        headers = {
+            "ETag": asset.etag,
+            "Cache-Control": (
+                f"public, max-age={config.static.fingerprinted_max_age}, immutable"
+                if fingerprinted
+                else f"public, max-age={config.static.max_age}"
+            ),
+        }
+        encoding = None
+        if asset.encoded:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            headers["ETag"] = encoded_etag(asset.etag, encoding)
+        if (if_none_match := request.headers.get("if-none-match")) and etag_matches(
+            if_none_match, asset.etag
+        ):
+            return Response(status_code=304, headers=headers)
+        if asset.content is None:
+            return FileResponse(
+                asset.file_path, media_type=asset.media_type, headers=headers
+            )
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(
+                asset.encoded[encoding], media_type=asset.media_type, headers=headers
+            )
+        return Response(asset.content, media_type=asset.media_type, headers=headers)
 
     return _static_endpoint
 
 
-# TODO extend the document list
-# TODO Move to core utils?
-DOCUMENT_TYPES = ["Note", "Article", "Document"]
-
-
-async def _create_timeline(uris: list[str], store: ResourceStore):
-    observed_resources = set()
-    timeline = []
-    for uri in uris:
-        activity = await store.get(uri)
-        obj = activity.get("object")
-        if isinstance(obj, str):
-            obj = await store.get(obj)
-        if (
-            obj
-            and obj["id"] not in observed_resources
-            and obj.get("type") in DOCUMENT_TYPES
-        ):
-            if activity.get("type") in ["Create", "Update"]:
-                timeline.append(obj)
-                observed_resources.add(obj["id"])
-                if len(timeline) >= 10:
-                    break
-    return timeline
-
-
-async def _actor_context(uri: str, store: ResourceStore):
+async def _actor_context(
+    uri: str,
+    store: ResourceStore,
+    timelines: ActorTimelines,
+    dependencies: set[str],
+):
     context = {}
     credentials = await store.query_one(
         {
@@ -87,16 +102,21 @@ async def _actor_context(uri: str, store: ResourceStore):
     )
     context["roles"] = credentials.get(FIRM_NS.role.value) if credentials else []
     actor = await store.get(uri)
-    outbox = await store.get(actor["outbox"])
-    timeline = await _create_timeline(outbox.get("orderedItems", []), store)
-    context["timeline"] = timeline
+    context["timeline"] = await timelines.get(actor["outbox"], store)
+    if credentials:
+        dependencies.add(credentials["id"])
+    dependencies.add(actor["outbox"])
+    dependencies.update(document["id"] for document in context["timeline"])
     return context
 
 
 @dataclass
 class TemplateConfig:
     template: str
-    context: Callable[[str, ResourceStore], Awaitable[dict[str, Any]]] | None = None
+    # Adds the URIs of other resources shown on the page to the dependencies
+    context: Callable[
+        [str, ResourceStore, ActorTimelines, set[str]], Awaitable[dict[str, Any]]
+    ] | None = None
 
 
 ACTOR_TEMPLATE = TemplateConfig("actor.jinja2", _actor_context)
@@ -112,24 +132,191 @@ RESOURCE_TEMPLATES: dict[str, TemplateConfig | str] = {
 }
 
 
-def _configure_tenant_templates(config: ServerConfig):
+TEMPLATES_DIR = "firm_server/html/templates"
+
+
+def _template_environment(
+    config: ServerConfig, manifest: StaticManifest
+) -> jinja2.Environment:
+    bytecode_cache = (
+        jinja2.FileSystemBytecodeCache(config.templates.bytecode_cache_dir)
+        if config.templates.bytecode_cache
+        else None
+    )
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+        autoescape=True,
+        bytecode_cache=bytecode_cache,
+    )
+
+    @jinja2.pass_context
+    def static_url(context: jinja2.runtime.Context, path: str) -> str:
+        return manifest.url(get_url_prefix(str(context["request"].url)), path)
+
+    env.globals["static_url"] = static_url
+    return env
+
+
+def _configure_tenant_templates(config: ServerConfig, manifest: StaticManifest):
+    """Templates by tenant, sharing one environment and bytecode cache.
+
+    Tenants with their own templates get an overlay of the shared
+    environment that looks in their directory first.
+    """
+    env = _template_environment(config, manifest)
+    default_templates = Jinja2Templates(env=env)
     tenant_templates = {}
     for tenant in config.tenants:
-        default_templates = Jinja2Templates(directory="firm_server/html/templates")
         prefix = urlparse(tenant)
         templates_dir = os.path.join(
             "firm_server/html/tenants", prefix.hostname or "", "templates"
         )
         tenant_templates[tenant] = (
-            Jinja2Templates(directory=[templates_dir, "firm_server/html/templates"])
+            Jinja2Templates(
+                env=env.overlay(
+                    loader=jinja2.ChoiceLoader(
+                        [jinja2.FileSystemLoader(templates_dir), env.loader]
+                    )
+                )
+            )
             if os.path.exists(templates_dir)
             else default_templates
         )
+    if config.templates.precompile:
+        _precompile({id(t.env): t.env for t in tenant_templates.values()}.values())
     return tenant_templates
 
 
-def html_endpoint(config: ServerConfig):
-    tenant_templates = _configure_tenant_templates(config)
+def _precompile(environments: Iterable[jinja2.Environment]) -> None:
+    start = time.perf_counter()
+    count = 0
+    for env in environments:
+        for name in env.list_templates(extensions=["jinja2"]):
+            env.get_template(name)
+            count += 1
+    log.info("Compiled %d templates in %.3fs", count, time.perf_counter() - start)
+
+
+def _chunked(parts: Iterator[str], chunk_size: int) -> Iterator[str]:
+    """Join rendered parts into chunks, ending the first after the head."""
+    buffer: list[str] = []
+    size = 0
+    in_head = True
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        end_of_head = in_head and "</head>" in part
+        if size >= chunk_size or end_of_head:
+            in_head = in_head and not end_of_head
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def _stream(
+    templates: Jinja2Templates, name: str, context: dict[str, Any], chunk_size: int
+) -> StreamingResponse:
+    """Render a template while it's being sent.
+
+    Errors after the first chunk can't change the response status, so
+    they end the response early.
+    """
+    template = templates.get_template(name)
+
+    async def _chunks() -> AsyncIterator[bytes]:
+        chunks = _chunked(template.generate(context), chunk_size)
+        while True:
+            with phase("render"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk.encode()
+
+    return StreamingResponse(_chunks(), media_type="text/html")
+
+
+def _render(
+    templates: Jinja2Templates,
+    name: str,
+    context: dict[str, Any],
+    config: TemplatesConfig | None = None,
+) -> Response:
+    if config is not None and config.streaming:
+        return _stream(templates, name, context, config.stream_chunk_size)
+    with phase("render"):
+        return templates.TemplateResponse(name, context)
+
+
+def html_endpoint(
+    config: ServerConfig,
+    store: ResourceStore | None = None,
+    manifest: StaticManifest | None = None,
+):
+    tenant_templates = _configure_tenant_templates(
+        config, manifest or StaticManifest(config)
+    )
+    page_cache = None
+    if isinstance(store, ObservableStore):
+        timelines = ActorTimelines()
+        store.add_listener(timelines.changed)
+        if config.caching.page_cache:
+            page_cache = PageCache(
+                config.caching.page_cache_max_bytes, config.caching.page_cache_ttl
+            )
+            store.add_listener(page_cache.changed)
+    else:
+        # Without change notifications, timelines are built on every read
+        timelines = ActorTimelines(max_size=0)
+
+    async def _resource_page(
+        request: HttpRequest, templates: Jinja2Templates, dependencies: set[str]
+    ) -> HttpResponse:
+        """Render a stored resource, collecting the URIs of what it shows.
+
+        Resources without a template are returned as JSON and have no
+        dependencies.
+        """
+        store = request.app.state.store
+        resource = await store.get(str(request.url))
+        if not resource:
+            return Response("Resource not found", status_code=404)
+        if template_config := RESOURCE_TEMPLATES.get(resource.get("type")):
+            if isinstance(template_config, str):
+                template_config = TemplateConfig(template_config)
+            context = dict(
+                request=request,
+                get_version=get_version,
+                resource=resource,
+            )
+            if template_config.context:
+                context.update(
+                    await template_config.context(
+                        str(request.url), store, timelines, dependencies
+                    )
+                )
+            dependencies.add(resource["id"])
+            return _render(
+                templates, template_config.template, context, config.templates
+            )
+        return JSONResponse(resource)
+
+    async def _cache_streamed(
+        chunks: AsyncIterable[bytes],
+        token: object,
+        uri: str,
+        variant: str,
+        dependencies: set[str],
+    ) -> AsyncIterator[bytes]:
+        """Pass a streamed page through, caching it once it's complete."""
+        body = []
+        async for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+        page_cache.put_page(
+            token, uri, variant, HTMLResponse(b"".join(body)), dependencies
+        )
 
     async def _endpoint(request: HttpRequest) -> HttpResponse:
         uri = str(request.url)
@@ -141,40 +328,59 @@ def html_endpoint(config: ServerConfig):
             # store = request.app.state.store
             # resource = await store.get(str(request.url))
             # if not resource:
-            return templates.TemplateResponse(
+            return _render(
+                templates,
                 "home.jinja2",
                 dict(
                     request=request,
                     get_version=get_version,
                 ),
+                config.templates,
             )
         elif request.url.path == "/login":
-            return templates.TemplateResponse(
+            return _render(
+                templates,
                 "login.jinja2",
                 dict(
                     request=request,
                     get_version=get_version,
                 ),
+                config.templates,
             )
         else:
-            store = request.app.state.store
-            resource = await store.get(str(request.url))
-            if not resource:
-                return Response("Resource not found", status_code=404)
+            if page_cache is None:
+                return await _resource_page(request, templates, set())
+            uri = str(request.url)
+            if (entry := page_cache.get(uri, prefix)) is not None:
+                LOOKUPS.inc(result="hit")
+                etag = dict(entry.raw_headers)[b"etag"].decode()
+                if (
+                    if_none_match := request.headers.get("if-none-match")
+                ) and etag_matches(if_none_match, etag):
+                    response = Response(status_code=304, headers={"ETag": etag})
+                    if is_encodable(entry, config.compression):
+                        encode_validators(
+                            response.headers,
+                            request.headers.get("accept-encoding", ""),
+                        )
+                    return response
             else:
-                if template_config := RESOURCE_TEMPLATES.get(resource.get("type")):
-                    if isinstance(template_config, str):
-                        template_config = TemplateConfig(template_config)
-                    context = dict(
-                        request=request,
-                        get_version=get_version,
-                        resource=resource,
+                LOOKUPS.inc(result="miss")
+                token = page_cache.begin(uri)
+                dependencies: set[str] = set()
+                response = await _resource_page(request, templates, dependencies)
+                if not dependencies or response.status_code != 200:
+                    return response
+                if isinstance(response, StreamingResponse):
+                    response.body_iterator = _cache_streamed(
+                        response.body_iterator, token, uri, prefix, dependencies
                     )
-                    if template_config.context:
-                        context.update(
-                            await template_config.context(str(request.url), store)
-                        )
-                    return templates.TemplateResponse(template_config.template, context)
-                return JSONResponse(resource)
+                    return response
+                entry = page_cache.put_page(token, uri, prefix, response, dependencies)
+                if entry is None:
+                    return response
+            return cached_response(
+                request, page_cache, uri, prefix, entry, config.compression
+            )
 
     return _endpoint
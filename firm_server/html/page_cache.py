@@ -0,0 +1,110 @@
+from collections import deque
+from typing import Iterable
+
+from starlette.responses import Response
+
+from firm_server.conditional import content_etag
+from firm_server.metrics import REGISTRY
+from firm_server.response_cache import CachedResponse, ResponseCache
+
+LOOKUPS = REGISTRY.counter(
+    "firm_page_cache_lookups_total",
+    "Rendered HTML page cache lookups",
+    ["result"],
+)
+
+
+def _key(uri: str) -> str:
+    return uri.rstrip("/")
+
+
+class _Fill:
+    """A pending page, with the change sequence number when it was started."""
+
+    def __init__(self, sequence: int) -> None:
+        self.sequence = sequence
+
+
+class PageCache(ResponseCache):
+    """Rendered pages, invalidated by changes to the resources they show.
+
+    A page depends on its own resource and on anything it embeds, such as
+    an actor's outbox and timeline documents. A page rendered while one
+    of its dependencies changed is not stored. Recent changes are kept to
+    check this, so a render that outlasts `max_changes` changes isn't
+    stored either. Since this covers changes to the page's own resource,
+    pages being rendered aren't tracked, and a render that isn't stored
+    (an error, an uncacheable response or an aborted stream) leaves
+    nothing behind.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, max_changes: int = 1024) -> None:
+        super().__init__(max_bytes, ttl, name="firm_page_cache")
+        self._sequence = 0
+        self._changes: deque[tuple[int, str]] = deque(maxlen=max_changes)
+        # resource URI -> pages showing it, and the reverse
+        self._dependents: dict[str, set[str]] = {}
+        self._dependencies: dict[str, set[str]] = {}
+
+    def begin(self, uri: str) -> object:
+        # The page's own URI is one of its dependencies, so nothing is kept
+        # per pending page and fills that are never stored need no cleanup
+        return _Fill(self._sequence)
+
+    def put_page(
+        self,
+        token: object,
+        uri: str,
+        variant: str,
+        response: Response,
+        dependencies: Iterable[str],
+    ) -> CachedResponse | None:
+        """Cache a rendered page unless its dependencies changed meanwhile."""
+        dependencies = {_key(d) for d in dependencies} | {_key(uri)}
+        if not isinstance(token, _Fill) or self._changed_since(
+            token.sequence, dependencies
+        ):
+            return None
+        response.headers["ETag"] = content_etag(response.body)
+        uri = _key(uri)
+        if (entry := self._store(uri, variant, response)) is None:
+            return None
+        self._dependencies.setdefault(uri, set()).update(dependencies)
+        for dependency in dependencies:
+            self._dependents.setdefault(dependency, set()).add(uri)
+        return entry
+
+    def _changed_since(self, sequence: int, uris: set[str]) -> bool:
+        if self._sequence - sequence > len(self._changes):
+            # Older changes have been forgotten
+            return True
+        for change_sequence, uri in reversed(self._changes):
+            if change_sequence <= sequence:
+                break
+            if uri in uris:
+                return True
+        return False
+
+    def changed(self, uri: str) -> None:
+        """Store listener."""
+        uri = _key(uri)
+        self._sequence += 1
+        self._changes.append((self._sequence, uri))
+        self.invalidate(uri)
+        for page in list(self._dependents.get(uri, ())):
+            self.invalidate(page)
+
+    def _discard(self, key: tuple[str, str]) -> None:
+        super()._discard(key)
+        uri = key[0]
+        if uri not in self._variants:
+            for dependency in self._dependencies.pop(uri, ()):
+                if pages := self._dependents.get(dependency):
+                    pages.discard(uri)
+                    if not pages:
+                        del self._dependents[dependency]
+
+    def clear(self) -> None:
+        super().clear()
+        self._dependents.clear()
+        self._dependencies.clear()
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+from firm_server.compression import ENCODINGS, compress, is_compressible
+from firm_server.config import ServerConfig
+
+log = logging.getLogger(__name__)
+
+STATIC_DIR = "firm_server/html/static"
+STATIC_URL_PATH = "/static/"
+
+
+@dataclass(frozen=True)
+class StaticAsset:
+    file_path: str
+    media_type: str
+    size: int
+    etag: str
+    # Held for files up to the configured size
+    content: bytes | None = None
+    # Content-Encoding -> compressed content
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def fingerprint(self) -> str:
+        return self.etag.strip('"')[:12]
+
+
+def tenant_static_dirs(config: ServerConfig) -> dict[str, list[str]]:
+    """Static directories by tenant prefix, tenant overrides first."""
+    static_dirs = {}
+    for tenant in config.tenants:
+        prefix = urlparse(tenant)
+        static_dir = os.path.join(
+            "firm_server/html/tenants", prefix.hostname or "", "static"
+        )
+        static_dirs[tenant] = (
+            [static_dir, STATIC_DIR] if os.path.exists(static_dir) else [STATIC_DIR]
+        )
+    return static_dirs
+
+
+def _fingerprinted(path: str, fingerprint: str) -> str:
+    base, ext = os.path.splitext(path)
+    return f"{base}.{fingerprint}{ext}"
+
+
+class StaticManifest:
+    """The tenants' static files, read once at startup.
+
+    Assets are found by their URL path, or by a fingerprinted path with
+    a content hash before the extension (see `url`), so serving them needs
+    no file system access. Larger files are served from disk.
+    """
+
+    def __init__(self, config: ServerConfig) -> None:
+        self.config = config
+        # tenant -> URL path -> asset
+        self._assets: dict[str, dict[str, StaticAsset]] = {}
+        # tenant -> fingerprinted URL path -> asset
+        self._fingerprinted: dict[str, dict[str, StaticAsset]] = {}
+        # Files shared by tenants are read once
+        assets: dict[str, StaticAsset] = {}
+        for tenant, static_dirs in tenant_static_dirs(config).items():
+            tenant_assets: dict[str, StaticAsset] = {}
+            # Earlier directories override later ones
+            for static_dir in reversed(static_dirs):
+                for root, _, filenames in os.walk(static_dir):
+                    for filename in filenames:
+                        file_path = os.path.join(root, filename)
+                        if file_path not in assets:
+                            assets[file_path] = self._load(file_path)
+                        path = os.path.relpath(file_path, static_dir)
+                        tenant_assets[path.replace(os.sep, "/")] = assets[file_path]
+            self._assets[tenant] = tenant_assets
+            self._fingerprinted[tenant] = {
+                _fingerprinted(path, asset.fingerprint): asset
+                for path, asset in tenant_assets.items()
+            }
+        log.info("Loaded %d static files", len(assets))
+
+    def _load(self, file_path: str) -> StaticAsset:
+        media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        if os.path.getsize(file_path) > self.config.static.memory_max_file_size:
+            digest = hashlib.sha256()
+            size = 0
+            with open(file_path, "rb") as f:
+                while chunk := f.read(64 * 1024):
+                    digest.update(chunk)
+                    size += len(chunk)
+            return StaticAsset(
+                file_path, media_type, size, f'"{digest.hexdigest()[:16]}"'
+            )
+        with open(file_path, "rb") as f:
+            content = f.read()
+        etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        compression = self.config.compression
+        encoded = (
+            {
+                encoding: compress(content, encoding, compression)
+                for encoding in ENCODINGS
+            }
+            if compression.enabled
+            and is_compressible(media_type)
+            and len(content) >= compression.minimum_size
+            else {}
+        )
+        return StaticAsset(file_path, media_type, len(content), etag, content, encoded)
+
+    def find(self, tenant: str, path: str) -> tuple[StaticAsset, bool] | None:
+        """The asset for a URL path, and whether the path was fingerprinted."""
+        if (asset := self._assets.get(tenant, {}).get(path)) is not None:
+            return asset, False
+        if (asset := self._fingerprinted.get(tenant, {}).get(path)) is not None:
+            return asset, True
+        return None
+
+    def url(self, tenant: str, path: str) -> str:
+        """A fingerprinted URL path for a static file, if it's known."""
+        if (asset := self._assets.get(tenant, {}).get(path)) is None:
+            return STATIC_URL_PATH + path
+        return STATIC_URL_PATH + _fingerprinted(path, asset.fingerprint)
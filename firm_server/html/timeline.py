@@ -0,0 +1,215 @@
+import contextlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterable, AsyncIterator
+
+from firm.interfaces import JSONObject, ResourceStore
+
+from firm_server.store import get_many
+
+# TODO extend the document list
+# TODO Move to core utils?
+DOCUMENT_TYPES = ["Note", "Article", "Document"]
+
+
+TIMELINE_SIZE = 10
+# Outbox items read per batch while building a timeline
+TIMELINE_BATCH_SIZE = 20
+
+
+def _item_id(item: str | JSONObject) -> str | None:
+    return item if isinstance(item, str) else item.get("id")
+
+
+async def _outbox_items(
+    store: ResourceStore, uri: str
+) -> AsyncIterator[str | JSONObject]:
+    """Outbox items newest first, from the collection log if there is one."""
+    if (iter_items := getattr(store, "iter_items", None)) is not None:
+        async for item in iter_items(uri):
+            yield item
+    elif outbox := await store.get(uri):
+        for item in outbox.get("orderedItems", []):
+            yield item
+
+
+async def _batches(
+    items: AsyncIterable[str | JSONObject], size: int
+) -> AsyncIterator[list[str | JSONObject]]:
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _create_timeline(
+    items: AsyncIterable[str | JSONObject], store: ResourceStore
+) -> list[JSONObject]:
+    """The newest documents created or updated by the activities in items."""
+    observed_resources = set()
+    timeline = []
+    async with contextlib.aclosing(_batches(items, TIMELINE_BATCH_SIZE)) as batches:
+        async for batch in batches:
+            # Embedded activities and objects aren't fetched
+            activity_uris = [item for item in batch if isinstance(item, str)]
+            fetched = dict(zip(activity_uris, await get_many(store, activity_uris)))
+            activities = [
+                fetched.get(item) if isinstance(item, str) else item for item in batch
+            ]
+            activities = [
+                activity
+                for activity in activities
+                if activity and activity.get("type") in ["Create", "Update"]
+            ]
+            object_uris = [
+                activity["object"]
+                for activity in activities
+                if isinstance(activity.get("object"), str)
+            ]
+            objects = dict(zip(object_uris, await get_many(store, object_uris)))
+            for activity in activities:
+                obj = activity.get("object")
+                if isinstance(obj, str):
+                    obj = objects.get(obj)
+                if (
+                    obj
+                    and obj["id"] not in observed_resources
+                    and obj.get("type") in DOCUMENT_TYPES
+                ):
+                    timeline.append(obj)
+                    observed_resources.add(obj["id"])
+                    if len(timeline) >= TIMELINE_SIZE:
+                        return timeline
+    return timeline
+
+
+@dataclass
+class _Timeline:
+    # The newest outbox item reflected in the documents
+    head: str | None
+    documents: list[JSONObject]
+    # Set by store changes, cleared when the timeline is brought up to date
+    outbox_changed: bool = False
+    stale: bool = False
+    document_ids: set[str] = field(default_factory=set)
+
+
+class ActorTimelines:
+    """Materialized public document timelines, by outbox URI.
+
+    A timeline is built from the outbox on first use. After that, new
+    outbox items are folded in by reading only the items added since the
+    last read, so rendering a profile doesn't scan past activities that
+    aren't documents. A change to one of the documents (an update, a
+    Tombstone or a removal) rebuilds the timeline on its next read.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max_size
+        self._timelines: OrderedDict[str, _Timeline] = OrderedDict()
+        # document URI -> outboxes with timelines that show it
+        self._outboxes: dict[str, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._timelines)
+
+    def changed(self, uri: str) -> None:
+        """Store listener."""
+        if (timeline := self._timelines.get(uri)) is not None:
+            timeline.outbox_changed = True
+        for outbox_uri in self._outboxes.get(uri, ()):
+            self._timelines[outbox_uri].stale = True
+
+    async def get(self, outbox_uri: str, store: ResourceStore) -> list[JSONObject]:
+        timeline = self._timelines.get(outbox_uri)
+        if timeline is None or timeline.stale:
+            timeline = await self._build(outbox_uri, store)
+        elif timeline.outbox_changed:
+            timeline.outbox_changed = False
+            if not await self._update(outbox_uri, timeline, store):
+                timeline = await self._build(outbox_uri, store)
+        else:
+            self._timelines.move_to_end(outbox_uri)
+        return timeline.documents
+
+    async def _build(self, outbox_uri: str, store: ResourceStore) -> _Timeline:
+        # Created before reading so changes made meanwhile are recorded
+        timeline = _Timeline(None, [])
+        self._set(outbox_uri, timeline)
+        head = None
+
+        async def _items():
+            nonlocal head
+            async for item in _outbox_items(store, outbox_uri):
+                if head is None:
+                    head = _item_id(item)
+                yield item
+
+        documents = await _create_timeline(_items(), store)
+        if self._timelines.get(outbox_uri) is timeline:
+            timeline.head = head
+            self._set_documents(outbox_uri, timeline, documents)
+        else:
+            # Evicted while building
+            timeline.documents = documents
+        return timeline
+
+    async def _update(
+        self, outbox_uri: str, timeline: _Timeline, store: ResourceStore
+    ) -> bool:
+        """Add documents from items added since the timeline's head.
+
+        Returns False if the head is no longer in the outbox.
+        """
+        new_items = []
+        async with contextlib.aclosing(_outbox_items(store, outbox_uri)) as items:
+            async for item in items:
+                if _item_id(item) == timeline.head:
+                    break
+                new_items.append(item)
+            else:
+                if timeline.head is not None:
+                    return False
+        if not new_items:
+            return True
+
+        async def _items():
+            for item in new_items:
+                yield item
+
+        documents = await _create_timeline(_items(), store)
+        ids = {document["id"] for document in documents}
+        documents += [d for d in timeline.documents if d["id"] not in ids]
+        timeline.head = _item_id(new_items[0])
+        self._set_documents(outbox_uri, timeline, documents[:TIMELINE_SIZE])
+        return True
+
+    def _set(self, outbox_uri: str, timeline: _Timeline) -> None:
+        self._discard(outbox_uri)
+        self._timelines[outbox_uri] = timeline
+        while len(self._timelines) > self.max_size:
+            self._discard(next(iter(self._timelines)))
+
+    def _set_documents(
+        self, outbox_uri: str, timeline: _Timeline, documents: list[JSONObject]
+    ) -> None:
+        self._unlink(outbox_uri, timeline)
+        timeline.documents = documents
+        timeline.document_ids = {document["id"] for document in documents}
+        for document_id in timeline.document_ids:
+            self._outboxes.setdefault(document_id, set()).add(outbox_uri)
+
+    def _unlink(self, outbox_uri: str, timeline: _Timeline) -> None:
+        for document_id in timeline.document_ids:
+            if outboxes := self._outboxes.get(document_id):
+                outboxes.discard(outbox_uri)
+                if not outboxes:
+                    del self._outboxes[document_id]
+
+    def _discard(self, outbox_uri: str) -> None:
+        if (timeline := self._timelines.pop(outbox_uri, None)) is not None:
+            self._unlink(outbox_uri, timeline)
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass, replace
+from typing import Callable
+
+from firm.auth.http_signature import HttpSignatureAuth
+from firm.interfaces import FIRM_NS, Authenticator, JSONObject, ResourceStore
+from starlette.authentication import AuthCredentials, BaseUser
+from starlette.requests import HTTPConnection
+
+from firm_server.adapters import AuthenticationBackendAdapter, HttpConnectionAdapter
+from firm_server.cache import MISSING, TtlCache
+from firm_server.config import PublicKeyCacheConfig
+from firm_server.metrics import REGISTRY
+from firm_server.store import ResourceStoreWrapper
+from firm_server.timing import phase
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class _SigningKey:
+    credentials_uri: str
+    public_key: JSONObject
+    private_key_pem: str
+    auth: HttpSignatureAuth
+    loaded: float
+
+
+class SigningKeyCache:
+    """HTTP signature signers for local actors, keyed by actor id.
+
+    A signer (and its parsed private key) is built once per key and is
+    used without store reads. `changed` drops it when the actor or
+    credentials documents change. Keys rewritten by other processes (the
+    `firm` CLI) don't notify it, so entries older than `max_age` are
+    revalidated against those documents before they're used.
+    """
+
+    def __init__(self, store: ResourceStore, max_age: float = 300.0) -> None:
+        self._store = store
+        self.max_age = max_age
+        self._keys: dict[str, _SigningKey] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        # credentials URI -> actor URI
+        self._actors: dict[str, str] = {}
+
+    def invalidate(self, actor_uri: str | None = None) -> None:
+        if actor_uri is None:
+            self._keys.clear()
+            self._actors.clear()
+        elif (key := self._keys.pop(actor_uri, None)) is not None:
+            self._actors.pop(key.credentials_uri, None)
+
+    def changed(self, uri: str) -> None:
+        """Store listener."""
+        self.invalidate(self._actors.get(uri, uri))
+
+    async def _is_current(self, key: _SigningKey, actor: JSONObject) -> bool:
+        if actor.get("publicKey") != key.public_key:
+            return False
+        credentials = await self._store.get(key.credentials_uri)
+        return bool(credentials) and (
+            credentials.get(FIRM_NS.privateKey.value) == key.private_key_pem
+        )
+
+    async def _load(self, actor: JSONObject) -> _SigningKey | None:
+        public_key = actor.get("publicKey", {})
+        key_uri = public_key.get("id")
+        if not key_uri:
+            log.error("No key for actor %s", actor["id"])
+            return None
+        credentials = await self._store.query_one(
+            {
+                "@prefix": "urn:",  # private
+                "type": FIRM_NS.Credentials.value,
+                "attributedTo": actor["id"],
+            }
+        )
+        private_key_pem = (
+            credentials.get(FIRM_NS.privateKey.value) if credentials else None
+        )
+        if not private_key_pem:
+            log.error("No private key found for actor %s", actor["id"])
+            return None
+        return _SigningKey(
+            credentials["id"],
+            public_key,
+            private_key_pem,
+            HttpSignatureAuth(key_uri, private_key_pem),
+            time.monotonic(),
+        )
+
+    async def get(self, actor_uri: str) -> HttpSignatureAuth | None:
+        if (lock := self._locks.get(actor_uri)) is None:
+            lock = self._locks[actor_uri] = asyncio.Lock()
+        async with lock:
+            key = self._keys.get(actor_uri)
+            if key is not None and time.monotonic() - key.loaded < self.max_age:
+                return key.auth
+            actor = await self._store.get(actor_uri)
+            if not actor:
+                log.error("Actor not found %s", actor_uri)
+                self.invalidate(actor_uri)
+                return None
+            if key is not None and await self._is_current(key, actor):
+                key = replace(key, loaded=time.monotonic())
+            else:
+                self.invalidate(actor_uri)
+                if (key := await self._load(actor)) is None:
+                    return None
+            self._keys[actor_uri] = key
+            self._actors[key.credentials_uri] = actor_uri
+            return key.auth
+
+
+KEY_LOOKUPS = REGISTRY.counter(
+    "firm_public_key_lookups_total",
+    "Remote key documents requested during signature verification",
+    ["result"],
+)
+
+_KEY_ID = re.compile(r'keyId="[^"]+"')
+
+
+class PublicKeyCache:
+    """Remote documents resolved while verifying HTTP signatures, by URI.
+
+    Signature verification reads the sender's key (or actor) document
+    through the store, which fetches it remotely. Those documents are
+    cached with a TTL, including a shorter-lived negative entry for keys
+    that can't be resolved. Local documents are never cached.
+    """
+
+    def __init__(
+        self,
+        store: ResourceStore,
+        is_local: Callable[[str], bool],
+        config: PublicKeyCacheConfig | None = None,
+    ) -> None:
+        self.store = store
+        self._is_local = is_local
+        self._config = config or PublicKeyCacheConfig()
+        # uri -> (time fetched, document or None)
+        self._entries: TtlCache[str, tuple[float, JSONObject | None]] = TtlCache(
+            self._config.ttl, self._config.max_size
+        )
+
+    def view(self) -> "_KeyCacheView":
+        return _KeyCacheView(self)
+
+    async def get(self, uri: str, refreshable: set[str]) -> JSONObject | None:
+        if self._is_local(uri):
+            return await self.store.get(uri)
+        if (entry := self._entries.get(uri, MISSING)) is not MISSING:
+            fetched, document = entry
+            KEY_LOOKUPS.inc(result="hit" if document else "negative")
+            if time.monotonic() - fetched >= self._config.min_refresh_interval:
+                refreshable.add(uri)
+            return document
+        KEY_LOOKUPS.inc(result="miss")
+        document = await self.store.get(uri)
+        self._entries.set(
+            uri,
+            (time.monotonic(), document),
+            None if document else self._config.negative_ttl,
+        )
+        return document
+
+    def invalidate(self, uris: set[str]) -> None:
+        for uri in uris:
+            self._entries.pop(uri)
+
+
+class _KeyCacheView(ResourceStoreWrapper):
+    """The store as seen by one authentication, recording cached reads."""
+
+    def __init__(self, cache: PublicKeyCache) -> None:
+        super().__init__(cache.store)
+        self._cache = cache
+        # Cached entries old enough to be refetched
+        self.refreshable: set[str] = set()
+
+    async def get(self, uri: str) -> JSONObject | None:
+        return await self._cache.get(uri, self.refreshable)
+
+
+class CachingAuthenticationBackend(AuthenticationBackendAdapter):
+    """Authenticates through a public key cache.
+
+    If a signed request fails verification with cached key documents,
+    they're refetched once in case the sender rotated its key.
+    """
+
+    def __init__(self, authenticator: Authenticator, keys: PublicKeyCache) -> None:
+        super().__init__(authenticator, keys.store)
+        self._keys = keys
+
+    async def _authenticate_with(
+        self, request: HTTPConnection, view: _KeyCacheView
+    ) -> tuple[AuthCredentials, BaseUser]:
+        identity = await self._authenticator.authenticate(
+            HttpConnectionAdapter(request, view)
+        )
+        return self._result(identity)
+
+    async def authenticate(
+        self, request: HTTPConnection
+    ) -> tuple[AuthCredentials, BaseUser]:
+        with phase("auth"):
+            return await self._authenticate(request)
+
+    async def _authenticate(
+        self, request: HTTPConnection
+    ) -> tuple[AuthCredentials, BaseUser]:
+        view = self._keys.view()
+        credentials, user = await self._authenticate_with(request, view)
+        if (
+            not user.is_authenticated
+            and view.refreshable
+            and _KEY_ID.search(request.headers.get("signature", ""))
+        ):
+            log.info("Refreshing keys after failed verification: %s", view.refreshable)
+            self._keys.invalidate(view.refreshable)
+            credentials, user = await self._authenticate_with(
+                request, self._keys.view()
+            )
+        return credentials, user
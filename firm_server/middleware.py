@@ -0,0 +1,86 @@
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# The request body, read once by BodyLimitMiddleware
+BODY_SCOPE_KEY = "firm.body"
+# The connection's peer address, recorded by PeerAddressMiddleware
+PEER_SCOPE_KEY = "firm.peer"
+
+_NO_BODY_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class BodyLimitMiddleware:
+    """Reads request bodies up to a maximum size, rejecting larger ones with 413.
+
+    A declared Content-Length over the limit is rejected before anything
+    is read. Otherwise the body is read as it arrives and abandoned as
+    soon as it exceeds the limit. The body is stored in the scope so
+    every consumer (signature digest checks, JSON parsing) shares the
+    single read, and it's also replayed to the app's `receive`.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int) -> None:
+        self.app = app
+        self.max_size = max_size
+
+    async def _reject(self, scope: Scope, receive: Receive, send: Send) -> None:
+        response = PlainTextResponse("Request body too large", status_code=413)
+        await response(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] in _NO_BODY_METHODS:
+            await self.app(scope, receive, send)
+            return
+        for key, value in scope["headers"]:
+            if key == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > self.max_size:
+                    await self._reject(scope, receive, send)
+                    return
+                break
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_size:
+                await self._reject(scope, receive, send)
+                return
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                break
+        body = scope[BODY_SCOPE_KEY] = b"".join(chunks)
+        replayed = False
+
+        async def replay() -> Message:
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay, send)
+
+
+class PeerAddressMiddleware:
+    """Records the connection's peer address before proxy headers are applied.
+
+    Proxy headers (`X-Forwarded-For`) replace the scope's client with
+    whatever the caller sends, so access checks that must not be spoofed
+    use the peer address recorded here. It must wrap the proxy headers
+    middleware.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] in ("http", "websocket"):
+            scope[PEER_SCOPE_KEY] = scope.get("client")
+        await self.app(scope, receive, send)
@@ -0,0 +1,127 @@
+from typing import Any, AsyncIterator, Callable, Mapping
+
+from firm.interfaces import HttpException, JSONObject
+
+PAGE_PARAMS = ("page", "max_seq", "min_seq")
+
+_PAGE_TYPES = {
+    "OrderedCollection": ("orderedItems", "OrderedCollectionPage"),
+    "Collection": ("items", "CollectionPage"),
+}
+
+
+def _seq_param(query: Mapping[str, str], name: str) -> int | None:
+    if (value := query.get(name)) is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HttpException(400, f"Invalid {name}: {value}")
+
+
+def _summary(collection: JSONObject, items_key: str, total: int) -> JSONObject:
+    summary = {k: v for k, v in collection.items() if k != items_key}
+    summary["totalItems"] = total
+    summary["first"] = f"{collection['id']}?page=true"
+    return summary
+
+
+def _page_bounds(
+    uri: str, query: Mapping[str, str], total: int, page_size: int
+) -> tuple[str, int, int]:
+    """The page ID and the range of item positions (newest first) on it."""
+    max_seq = _seq_param(query, "max_seq")
+    min_seq = _seq_param(query, "min_seq")
+    if max_seq is not None:
+        start = min(max(total - 1 - max_seq, 0), total)
+        return f"{uri}?page=true&max_seq={max_seq}", start, start + page_size
+    if min_seq is not None:
+        end = min(max(total - 1 - min_seq, 0), total)
+        return f"{uri}?page=true&min_seq={min_seq}", max(end - page_size, 0), end
+    return f"{uri}?page=true", 0, page_size
+
+
+def _page(
+    collection: JSONObject,
+    page_type: tuple[str, str],
+    page_id: str,
+    items: list,
+    start: int,
+    total: int,
+) -> JSONObject:
+    items_key, page_type_name = page_type
+    uri = collection["id"]
+    page = {
+        "id": page_id,
+        "type": page_type_name,
+        "partOf": uri,
+        items_key: items,
+    }
+    if "@context" in collection:
+        page = {"@context": collection["@context"]} | page
+    if (end := start + len(items)) < total:
+        page["next"] = f"{uri}?page=true&max_seq={total - 1 - end}"
+    if start > 0:
+        page["prev"] = f"{uri}?page=true&min_seq={total - 1 - start}"
+    return page
+
+
+def page_collection(
+    collection: JSONObject, query: Mapping[str, str], page_size: int
+) -> JSONObject:
+    """Serve a collection as a summary with links to pages of its items.
+
+    Items are stored newest first, so an item's sequence number (its
+    position counted from the oldest end) doesn't change as items are
+    added. Pages are selected by sequence number cursors: `max_seq` for
+    the next (older) page and `min_seq` for the previous (newer) one.
+    Collections that fit in a page are returned whole unless a page is
+    requested.
+    """
+    page_type = _PAGE_TYPES.get(collection.get("type"))
+    if page_type is None:
+        return collection
+    items_key = page_type[0]
+    items = collection.get(items_key)
+    if not isinstance(items, list):
+        return collection
+    total = len(items)
+    if "page" not in query:
+        if total <= page_size:
+            return collection
+        return _summary(collection, items_key, total)
+    page_id, start, end = _page_bounds(collection["id"], query, total, page_size)
+    return _page(collection, page_type, page_id, items[start:end], start, total)
+
+
+async def page_log_collection(
+    summary: JSONObject,
+    query: Mapping[str, str],
+    page_size: int,
+    iter_items: Callable[[str, int | None], AsyncIterator[Any]],
+) -> JSONObject:
+    """Like `page_collection`, for a collection summary with `totalItems`.
+
+    The items on a page are read with `iter_items` (see
+    `CollectionLogStore`) from the page's first sequence number, so a
+    page costs the same however long the collection is.
+    """
+    uri = summary["id"]
+    total = summary.get("totalItems", 0)
+    page_type = _PAGE_TYPES["OrderedCollection"]
+
+    async def _read(start: int, end: int) -> list:
+        items = []
+        if start < min(end, total):
+            async for item in iter_items(uri, total - 1 - start):
+                items.append(item)
+                if len(items) == end - start:
+                    break
+        return items
+
+    if "page" not in query:
+        if total > page_size:
+            return _summary(summary, page_type[0], total)
+        return summary | {page_type[0]: await _read(0, total)}
+    page_id, start, end = _page_bounds(uri, query, total, page_size)
+    return _page(summary, page_type, page_id, await _read(start, end), start, total)
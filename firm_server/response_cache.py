@@ -0,0 +1,250 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from firm_server.compression import add_vary, compress, negotiate_encoding
+from firm_server.conditional import content_etag, encoded_etag
+from firm_server.config import CompressionConfig
+from firm_server.metrics import REGISTRY
+
+LOOKUPS = REGISTRY.counter(
+    "firm_response_cache_lookups_total",
+    "Response cache lookups for anonymous GETs",
+    ["result"],
+)
+
+
+def _hit_ratio() -> float:
+    hits = LOOKUPS.value(result="hit")
+    total = hits + LOOKUPS.value(result="miss")
+    return hits / total if total else 0.0
+
+
+HIT_RATIO = REGISTRY.gauge(
+    "firm_response_cache_hit_ratio",
+    "Fraction of response cache lookups that were hits",
+    function=_hit_ratio,
+)
+
+
+def _key(uri: str) -> str:
+    return uri.rstrip("/")
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    status_code: int
+    body: bytes
+    raw_headers: list[tuple[bytes, bytes]]
+    expires: float
+
+    # Content-Encoding -> compressed body
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return (
+            len(self.body)
+            + sum(len(body) for body in self.encoded.values())
+            + sum(len(k) + len(v) for k, v in self.raw_headers)
+        )
+
+    def response(self, encoding: str | None = None) -> Response:
+        if encoding is None:
+            response = Response(self.body, status_code=self.status_code)
+            response.raw_headers = list(self.raw_headers)
+            return response
+        body = self.encoded[encoding]
+        response = Response(body, status_code=self.status_code)
+        response.raw_headers = [
+            (k, v) for k, v in self.raw_headers if k != b"content-length"
+        ] + [(b"content-length", str(len(body)).encode())]
+        response.headers["Content-Encoding"] = encoding
+        if etag := response.headers.get("etag"):
+            response.headers["ETag"] = encoded_etag(etag, encoding)
+        add_vary(response.headers)
+        return response
+
+
+class ResponseCache:
+    """Encoded responses by (URI, variant), bounded by size with LRU eviction.
+
+    Entries are dropped when the store reports a change to their
+    resource. A response computed while its resource changed is not
+    stored, since it may have been built from the old version.
+    """
+
+    def __init__(
+        self, max_bytes: int, ttl: float, name: str = "firm_response_cache"
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: OrderedDict[tuple[str, str], CachedResponse] = OrderedDict()
+        # resource URI -> variants cached for it
+        self._variants: dict[str, set[str]] = {}
+        # resource URI -> token of the latest pending fill
+        self._pending: dict[str, object] = {}
+        REGISTRY.gauge(
+            f"{name}_bytes",
+            "Size of cached responses",
+            function=lambda: self.size,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uri: str, variant: str) -> CachedResponse | None:
+        key = (_key(uri), variant)
+        if (entry := self._entries.get(key)) is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def begin(self, uri: str) -> object:
+        """Start computing a response to cache, returning a token for `put`."""
+        token = self._pending[_key(uri)] = object()
+        return token
+
+    def put(
+        self, token: object, uri: str, variant: str, response: Response
+    ) -> CachedResponse | None:
+        uri = _key(uri)
+        if self._pending.get(uri) is not token:
+            return None
+        del self._pending[uri]
+        return self._store(uri, variant, response)
+
+    def _store(
+        self, uri: str, variant: str, response: Response
+    ) -> CachedResponse | None:
+        if "etag" not in response.headers:
+            response.headers["ETag"] = content_etag(response.body)
+        entry = CachedResponse(
+            response.status_code,
+            response.body,
+            list(response.raw_headers),
+            time.monotonic() + self.ttl,
+        )
+        if entry.size > self.max_bytes:
+            return None
+        self._discard((uri, variant))
+        self._entries[(uri, variant)] = entry
+        self._variants.setdefault(uri, set()).add(variant)
+        self.size += entry.size
+        self._evict()
+        return entry
+
+    def abort(self, token: object, uri: str) -> None:
+        """End a fill that won't be stored."""
+        if self._pending.get(uri := _key(uri)) is token:
+            del self._pending[uri]
+
+    def add_encoding(
+        self, uri: str, variant: str, entry: CachedResponse, encoding: str, body: bytes
+    ) -> None:
+        """Keep a compressed body with a cached response."""
+        if self._entries.get((_key(uri), variant)) is not entry:
+            return
+        entry.encoded[encoding] = body
+        self.size += len(body)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: tuple[str, str]) -> None:
+        if (entry := self._entries.pop(key, None)) is not None:
+            self.size -= entry.size
+            uri, variant = key
+            variants = self._variants[uri]
+            variants.discard(variant)
+            if not variants:
+                del self._variants[uri]
+
+    def invalidate(self, uri: str) -> None:
+        uri = _key(uri)
+        self._pending.pop(uri, None)
+        for variant in list(self._variants.get(uri, ())):
+            self._discard((uri, variant))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._variants.clear()
+        self._pending.clear()
+        self.size = 0
+
+
+def is_encodable(entry: CachedResponse, compression: CompressionConfig | None) -> bool:
+    """Whether `cached_response` compresses the entry for clients accepting it."""
+    return (
+        compression is not None
+        and compression.enabled
+        and len(entry.body) >= compression.minimum_size
+    )
+
+
+def cached_response(
+    request: Request,
+    cache: ResponseCache,
+    uri: str,
+    variant: str,
+    entry: CachedResponse,
+    compression: CompressionConfig | None = None,
+) -> Response:
+    """A cached response in the client's preferred encoding.
+
+    Compressed bodies are kept with the entry, so the same bytes are only
+    compressed once per encoding.
+    """
+    if not is_encodable(entry, compression) or not (
+        encoding := negotiate_encoding(request.headers.get("accept-encoding", ""))
+    ):
+        return entry.response()
+    if encoding not in entry.encoded:
+        body = compress(entry.body, encoding, compression)
+        cache.add_encoding(uri, variant, entry, encoding, body)
+        if encoding not in entry.encoded:
+            # Not kept, e.g. the entry was invalidated meanwhile
+            return entry.response()
+    return entry.response(encoding)
+
+
+def cached_endpoint(
+    endpoint: Callable[[Request], Awaitable[Response]],
+    cache: ResponseCache,
+    negotiate: Callable[[str], str],
+    compression: CompressionConfig | None = None,
+):
+    """Serves anonymous GETs from the cache, keyed by negotiated media type."""
+
+    async def wrapper(request: Request) -> Response:
+        if request.method not in ["GET", "HEAD"] or request.user.is_authenticated:
+            return await endpoint(request)
+        uri = str(request.url.replace(query=""))
+        variant = f"{negotiate(request.headers.get('accept', ''))}?{request.url.query}"
+        if (entry := cache.get(uri, variant)) is not None:
+            LOOKUPS.inc(result="hit")
+        else:
+            LOOKUPS.inc(result="miss")
+            token = cache.begin(uri)
+            try:
+                response = await endpoint(request)
+                if response.status_code != 200 or not hasattr(response, "body"):
+                    return response
+                if (entry := cache.put(token, uri, variant, response)) is None:
+                    return response
+            finally:
+                # No-op once the response is stored
+                cache.abort(token, uri)
+        return cached_response(request, cache, uri, variant, entry, compression)
+
+    return wrapper
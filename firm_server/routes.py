@@ -1,15 +1,13 @@
+import functools
 import logging
-from typing import Awaitable, Callable, Iterable
+from typing import Any, Awaitable, Callable, Mapping
 
-import httpx
 import mimeparse
 from firm.auth.authorization import CoreAuthorizationService
 from firm.auth.bearer_token import BearerTokenAuthenticator
 from firm.auth.chained import AuthenticatorChain
-from firm.auth.http_signature import HttpSigAuthenticator, HttpSignatureAuth
+from firm.auth.http_signature import HttpSigAuthenticator
 from firm.interfaces import (
-    FIRM_NS,
-    DeliveryService,
     HttpException,
     HttpRequest,
     HttpResponse,
@@ -22,35 +20,56 @@ from firm.interfaces import (
 from firm.services.activitypub import ActivityPubService, ActivityPubTenant
 from firm.services.nodeinfo import nodeinfo_index, nodeinfo_version
 from firm.services.webfinger import webfinger
-from firm.util import AP_PUBLIC_URIS, AS2_CONTENT_TYPES
+from firm.util import AS2_CONTENT_TYPES
 from firm_jsonschema.validation import create_validator
 from firm_ld.search import IndexedResource, SearchEngine
 from firm_ld.sparql import create_sparql_endpoint
 from firm_ld.store import RdfResourceStore
 from jsonschema.exceptions import ValidationError
+from starlette.datastructures import URLPath
 from starlette.exceptions import HTTPException
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse
 from starlette.responses import PlainTextResponse as StarlettePlainTextResponse
 from starlette.responses import Response
-from starlette.routing import Match, Mount, Route, Scope
-
-from firm_server.adapters import (
-    AuthenticationBackendAdapter,
-    HttpConnectionAdapter,
-    HttpxAuthAdapter,
+from starlette.routing import BaseRoute, Match, Mount, NoMatchFound, Route
+from starlette.types import Receive, Scope, Send
+
+from firm_server.adapters import HttpConnectionAdapter
+from firm_server.compression import encode_validators, is_compressible
+from firm_server.conditional import (
+    ResourceVersion,
+    ResourceVersions,
+    is_not_modified,
+    unencoded_etag,
 )
-from firm_server.config import ServerConfig
+from firm_server.config import CompressionConfig, ServerConfig
+from firm_server.delivery import FirmDeliveryService
+from firm_server.encoding import JSONResponse
 from firm_server.html.endpoint import html_endpoint, html_static_endpoint
+from firm_server.html.static import StaticManifest
+from firm_server.keys import CachingAuthenticationBackend, PublicKeyCache
+from firm_server.metrics import REGISTRY, MetricsRegistry
+from firm_server.middleware import PEER_SCOPE_KEY
+from firm_server.paging import PAGE_PARAMS, page_collection, page_log_collection
+from firm_server.response_cache import ResponseCache, cached_endpoint
+from firm_server.store import ObservableStore, collection_summaries, unwrap_store
+from firm_server.timing import phase
 
 log = logging.getLogger(__name__)
 
 
-def _adapt_response(r: HttpResponse) -> Response:
+def _adapt_response(
+    r: HttpResponse,
+    page_size: int | None = None,
+    query: Mapping[str, str] | None = None,
+) -> Response:
     if isinstance(r, JsonResponse):
-        return JSONResponse(r.json, status_code=r.status_code, headers=r.headers)
+        content = r.json
+        if page_size and r.status_code == 200 and isinstance(content, dict):
+            content = page_collection(content, query or {}, page_size)
+        return JSONResponse(content, status_code=r.status_code, headers=r.headers)
     if isinstance(r, PlainTextResponse):
         return StarlettePlainTextResponse(
             r.content, status_code=r.status_code, headers=r.headers
@@ -61,167 +80,205 @@ def _adapt_endpoint(
     method: Callable[[HttpRequest], Awaitable[HttpResponse]],
     store: ResourceStore,
     authenticated=False,
+    page_size: int | None = None,
 ) -> Response:
     async def wrapper(request: Request):
         try:
             if authenticated and not request.user.is_authenticated:
                 raise HTTPException(401)
-            return _adapt_response(await method(HttpConnectionAdapter(request, store)))
+            paged = page_size if request.method in ["GET", "HEAD"] else None
+            query = request.query_params
+            if paged and any(name in query for name in PAGE_PARAMS):
+                # The service resolves the collection from its URI without paging
+                request = Request(
+                    {**request.scope, "query_string": b""}, request.receive
+                )
+            if not paged:
+                return _adapt_response(
+                    await method(HttpConnectionAdapter(request, store))
+                )
+            # A log-backed collection is paged from its log, not read whole
+            uri = str(request.url.replace(query=""))
+            with collection_summaries(uri) as summary:
+                response = await method(HttpConnectionAdapter(request, store))
+            if (
+                summary.read
+                and isinstance(response, JsonResponse)
+                and response.status_code == 200
+                and isinstance(response.json, dict)
+                and response.json.get("id") == uri
+            ):
+                return JSONResponse(
+                    await page_log_collection(
+                        response.json, query, paged, store.iter_items
+                    ),
+                    headers=response.headers,
+                )
+            return _adapt_response(response, paged, query)
         except HttpException as e:
             raise HTTPException(e.status_code, detail=e.detail, headers=e.headers)
 
     return wrapper
 
 
-# TODO Move to util
-def is_collection(obj: JSONObject) -> bool:
-    return obj.get("type") in ["Collection", "OrderedCollection"]
-
-
-def is_local(prefix: str, uri: str):
-    return uri.startswith(prefix)
-
-
-def is_public(uri: str):
-    return uri in AP_PUBLIC_URIS
-
-
-# TODO Reconsider design of FirmDeliveryService (abstract class?)
-class FirmDeliveryService(DeliveryService):
-    _RECIPIENT_PROPS = ["to", "cc", "bto", "bcc"]
-
-    def __init__(self, config: ServerConfig, store: ResourceStore):
-        self._config = config
-        self._store = store
-
-    async def _resolve_inboxes(self, recipient_uris: Iterable[str]) -> set[str]:
-        inboxes = set()
-        for uri in recipient_uris:
-            if is_public(uri):
-                continue
-            obj = await self._store.get(uri)
-            if is_collection(obj):  # TODO and self._store.is_local(uri):
-                if items := obj.get("items") or obj.get("orderedItems"):
-                    for item in await self._resolve_inboxes(items):
-                        inboxes.add(item)
-            else:
-                if inbox := obj.get("sharedInbox") or obj.get("inbox"):
-                    inboxes.add(inbox)
-        return inboxes
-
-    def _remove_keys(self, obj: JSONObject, predicate: Callable[[str], bool]) -> None:
-        for key, value in obj.items():
-            if key.startswith("firm:"):
-                obj.pop(key)
-            else:
-                if isinstance(value, list):
-                    for item in value:
-                        if isinstance(item, dict):
-                            self._remove_keys(item, predicate)
-                else:
-                    if isinstance(value, dict):
-                        self._remove_keys(value, predicate)
-
-    async def _post(
-        self,
-        inbox: str,
-        /,
-        message: JSONObject,
-        auth: HttpSignatureAuth,
-    ) -> None:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                inbox,
-                json=message,
-                headers={"Content-Type": "application/activity+json"},
-                auth=HttpxAuthAdapter(auth, self._store),
-            )
-            log.info(
-                f"FirmDeliveryService POST {inbox} "
-                f"{response.status_code} text={response.text}"
-            )
+@functools.lru_cache(maxsize=256)
+def _negotiate_as2(accept: str) -> str:
+    return mimeparse.best_match(AS2_CONTENT_TYPES, accept)
+
+
+def _conditional_endpoint(
+    endpoint: Callable[[Request], Awaitable[Response]],
+    versions: ResourceVersions,
+    compression: CompressionConfig,
+):
+    """Adds validators to GET responses and answers 304 when they match."""
+
+    async def wrapper(request: Request) -> Response:
+        if request.method not in ["GET", "HEAD"]:
+            return await endpoint(request)
+        uri = str(request.url.replace(query=""))
+        identity = request.user.identity if request.user.is_authenticated else ""
+        media_type = _negotiate_as2(request.headers.get("accept", ""))
+        variant = f"{media_type}|{identity}?{request.url.query}"
+        if (version := versions.find(uri, variant)) is not None and is_not_modified(
+            request.headers, version.etag, version.modified
+        ):
+            response = Response(status_code=304, headers=_validators(version))
+            if version.encodable:
+                encode_validators(
+                    response.headers, request.headers.get("accept-encoding", "")
+                )
+            return response
+        token = versions.begin(uri)
+        try:
+            response = await endpoint(request)
+            if response.status_code == 200 and hasattr(response, "body"):
+                # Cached responses have an ETag, possibly for an encoded body
+                etag = response.headers.get("etag")
+                version = versions.put(
+                    token,
+                    uri,
+                    variant,
+                    response.body,
+                    unencoded_etag(etag) if etag else None,
+                    "content-encoding" in response.headers
+                    or (
+                        compression.enabled
+                        and len(response.body) >= compression.minimum_size
+                        and is_compressible(response.headers.get("content-type"))
+                    ),
+                )
+                if last_modified := version.last_modified:
+                    response.headers["Last-Modified"] = last_modified
+                if not etag:
+                    response.headers["ETag"] = version.etag
+            return response
+        finally:
+            # No-op once the version is kept
+            versions.abort(token, uri)
 
-    async def _serialize(self, activity: JSONObject) -> JSONObject:
-        message = activity.copy()
-        message.pop("bto", None)
-        message.pop("bcc", None)
-        self._remove_keys(message, lambda k: k.startswith("fir:"))
-        # TODO message specific serialization
-        # (selected object embedding, collection paging, etc.)
-        return message
-
-    async def deliver(self, activity: JSONObject) -> None:
-        # TODO Handle failures and redelivery
-        actor = await self._store.get(activity["actor"])
-        key_uri = actor.get("publicKey", {}).get("id")
-        if not key_uri:
-            log.error("No key for actor %s", actor["id"])
-            return
-        credentials = await self._store.query_one(
-            {
-                "@prefix": "urn:",  # private
-                "type": FIRM_NS.Credentials.value,
-                "attributedTo": actor["id"],
-            }
-        )
-        private_key_pem = credentials.get(FIRM_NS.privateKey.value)
-        if not private_key_pem:
-            log.error("No private key found for actor %s", actor["id"])
-            return
-        auth = HttpSignatureAuth(key_uri, private_key_pem)
-        recipient_uris: set[str] = set()
-        for prop in self._RECIPIENT_PROPS:
-            if r := activity.get(prop):
-                if isinstance(r, str):
-                    recipient_uris.add(r)
-                elif isinstance(r, list):
-                    recipient_uris.update(r)
-        inboxes = await self._resolve_inboxes(recipient_uris)
-        message = None
-        for inbox_uri in inboxes:
-            if self._config.is_local(inbox_uri):
-                inbox = await self._store.get(inbox_uri)
-                items = inbox.get("orderedItems", [])
-                items.insert(0, activity["id"])
-                inbox["orderedItems"] = items
-                await self._store.put(inbox)
-            else:
-                if message is None:
-                    message = await self._serialize(activity)
-                await self._post(inbox_uri, message=message, auth=auth)
+    return wrapper
+
+
+def _validators(version: ResourceVersion) -> dict[str, str]:
+    headers = {"ETag": version.etag}
+    if last_modified := version.last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
 
 
 class MimeTypeRoute(Route):
     def __init__(self, *args, **kwargs):
-        self._mimetypes = kwargs.pop("mimetypes", None)
+        self.mimetypes = kwargs.pop("mimetypes", None)
         super().__init__(*args, **kwargs)
 
+    def accepts(self, method: str, media_types: str) -> bool:
+        if self.mimetypes is None:
+            return True
+        if method in ["GET", "HEAD"]:
+            return bool(mimeparse.best_match(self.mimetypes, media_types))
+        return media_types in self.mimetypes
+
+
+class NegotiatingRoute(BaseRoute):
+    """Dispatches a path to the first route that accepts the request's media type.
+
+    The Accept (GET, HEAD) or Content-Type header is read once and the
+    negotiation result is memoized by the raw header value. Clients send
+    few distinct headers, so parsing them is rarely repeated.
+    """
+
+    def __init__(self, routes: list[MimeTypeRoute], cache_size: int = 256) -> None:
+        self.routes = routes
+        self._negotiate = functools.lru_cache(maxsize=cache_size)(self._select)
+
+    def _select(self, method: str, media_types: str) -> int | None:
+        for index, route in enumerate(self.routes):
+            if route.accepts(method, media_types):
+                return index
+        return None
+
     @staticmethod
-    def _get_header(scope: Scope, name: bytes) -> str | None:
+    def _get_header(scope: Scope, name: bytes) -> str:
         for key, value in scope["headers"]:
             if key == name:
                 return value.decode()
         return ""
 
-    def _matches_mimetype(self, scope: Scope) -> bool:
-        if scope["method"] in ["GET", "HEAD"]:
-            if accepted_types := self._get_header(scope, b"accept"):
-                return self._mimetypes is None or mimeparse.best_match(
-                    self._mimetypes, accepted_types
-                )
-            raise HTTPException(400, "No accept header")
-        elif content_type := self._get_header(scope, b"content-type"):
-            return self._mimetypes is None or content_type in self._mimetypes
-        else:
+    def matches(self, scope: Scope) -> tuple[Match, Scope]:
+        if scope["type"] != "http":
+            return Match.NONE, {}
+        method = "GET" if scope["method"] in ["GET", "HEAD"] else "POST"
+        if method == "GET":
+            if not (media_types := self._get_header(scope, b"accept")):
+                raise HTTPException(400, "No accept header")
+        elif not (media_types := self._get_header(scope, b"content-type")):
             raise HTTPException(400, "No content-type header")
+        index = self._negotiate(method, media_types)
+        if index is None:
+            return Match.NONE, {}
+        route = self.routes[index]
+        match, child_scope = route.matches(scope)
+        return match, {**child_scope, "negotiated_route": route}
+
+    def url_path_for(self, name: str, /, **path_params: Any) -> URLPath:
+        for route in self.routes:
+            try:
+                return route.url_path_for(name, **path_params)
+            except NoMatchFound:
+                pass
+        raise NoMatchFound(name, path_params)
+
+    async def handle(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await scope["negotiated_route"].handle(scope, receive, send)
+
+
+class _MetricsRoute(Route):
+    """Matches only requests from allowed client addresses.
+
+    The address is the connection's peer, not one from proxy headers,
+    when the app is served with `PeerAddressMiddleware`.
+    """
+
+    def __init__(self, allowed_clients: list[str], registry: MetricsRegistry) -> None:
+        super().__init__("/metrics", endpoint=_metrics_endpoint(registry))
+        self.allowed_clients = frozenset(allowed_clients)
 
     def matches(self, scope: Scope) -> tuple[Match, Scope]:
-        return (
-            super().matches(scope)
-            if self._matches_mimetype(scope)
-            else (Match.NONE, scope)
+        client = scope.get(PEER_SCOPE_KEY, scope.get("client"))
+        if not client or client[0] not in self.allowed_clients:
+            return Match.NONE, {}
+        return super().matches(scope)
+
+
+def _metrics_endpoint(registry: MetricsRegistry):
+    async def _endpoint(request: Request) -> Response:
+        return StarlettePlainTextResponse(
+            registry.render(), media_type="text/plain; version=0.0.4"
         )
 
+    return _endpoint
+
 
 def _rdf_search(store: RdfResourceStore) -> HttpResponse:
     # TODO support named graphs for search
@@ -275,12 +332,30 @@ class JsonSchemaValidator(Validator):
 
     def validate(self, obj: JSONObject) -> None:
         try:
-            self._validator.validate(obj)
+            with phase("validate"):
+                self._validator.validate(obj)
         except ValidationError as e:
             raise HttpException(400, e.message)
 
 
-def get_routes(store: ResourceStore, config: ServerConfig):
+def route_labels(routes: list[BaseRoute]) -> dict[Callable, str]:
+    """Names of routes by endpoint, for metrics."""
+    labels = {}
+    for route in routes:
+        if isinstance(route, NegotiatingRoute):
+            labels.update(route_labels(route.routes))
+        elif isinstance(route, MimeTypeRoute):
+            labels[route.endpoint] = route.name
+        elif isinstance(route, Route):
+            labels[route.endpoint] = route.path
+    return labels
+
+
+def get_routes(
+    store: ResourceStore,
+    config: ServerConfig,
+    delivery_service: FirmDeliveryService,
+):
     validator = JsonSchemaValidator(config)
     activitypub_service = ActivityPubService(
         [
@@ -288,28 +363,55 @@ def get_routes(store: ResourceStore, config: ServerConfig):
                 prefix=prefix,
                 store=store,
                 authorizer=CoreAuthorizationService(prefix, store),
-                delivery_service=FirmDeliveryService(config, store),
+                delivery_service=delivery_service,
                 validator=validator,
             )
             for prefix in config.tenants
         ]
     )
+    static_manifest = StaticManifest(config)
+    html_route = MimeTypeRoute(
+        "/{path:path}",
+        endpoint=html_endpoint(config, store, static_manifest),
+        name="html",
+        mimetypes=["text/html"],
+    )
+    activitypub_endpoint = _adapt_endpoint(
+        activitypub_service.process_request, store, page_size=config.paging.page_size
+    )
+    if isinstance(store, ObservableStore):
+        if config.caching.response_cache:
+            response_cache = ResponseCache(
+                config.caching.response_cache_max_bytes,
+                config.caching.response_cache_ttl,
+            )
+            store.add_listener(response_cache.invalidate)
+            activitypub_endpoint = cached_endpoint(
+                activitypub_endpoint, response_cache, _negotiate_as2, config.compression
+            )
+        if config.caching.conditional_get:
+            versions = ResourceVersions(config.caching.validator_ttl)
+            store.add_listener(versions.changed)
+            activitypub_endpoint = _conditional_endpoint(
+                activitypub_endpoint, versions, config.compression
+            )
     activitypub_route = MimeTypeRoute(
         "/{path:path}",
-        endpoint=_adapt_endpoint(activitypub_service.process_request, store),
+        endpoint=activitypub_endpoint,
+        name="activitypub",
         mimetypes=AS2_CONTENT_TYPES,
         methods=["GET", "POST"],
         middleware=[
             Middleware(
                 AuthenticationMiddleware,
-                backend=AuthenticationBackendAdapter(
+                backend=CachingAuthenticationBackend(
                     AuthenticatorChain(
                         [
                             BearerTokenAuthenticator(),
                             HttpSigAuthenticator(),
                         ]
                     ),
-                    store,
+                    PublicKeyCache(store, config.is_local, config.public_key_cache),
                 ),
             )
         ],
@@ -318,15 +420,15 @@ def get_routes(store: ResourceStore, config: ServerConfig):
         Route("/.well-known/webfinger", endpoint=_adapt_endpoint(webfinger, store)),
         Route("/.well-known/nodeinfo", endpoint=_adapt_endpoint(nodeinfo_index, store)),
         Route("/nodeinfo/{version}", endpoint=_adapt_endpoint(nodeinfo_version, store)),
-        Route("/static/{file_path:path}", endpoint=html_static_endpoint(config)),
-        MimeTypeRoute(
-            "/{path:path}",
-            endpoint=html_endpoint(config),
-            mimetypes=["text/html"],
+        Route(
+            "/static/{file_path:path}",
+            endpoint=html_static_endpoint(config, static_manifest),
         ),
-        activitypub_route,
     ]
-    if isinstance(store, RdfResourceStore):
+    if config.metrics.enabled:
+        routes.append(_MetricsRoute(config.metrics.allowed_clients, REGISTRY))
+    routes.append(NegotiatingRoute([html_route, activitypub_route]))
+    if isinstance(rdf_store := unwrap_store(store), RdfResourceStore):
         log.info("Registering SPARQL endpoint")
         example_query = """\
 PREFIX as: <https://www.w3.org/ns/activitystreams#>
@@ -343,7 +445,7 @@ SELECT ?object WHERE {
             example_query=example_query,
             favicon="https://firm.stevebate.dev/static/favicon/favicon.ico",
         )
-        routes.insert(4, Mount("/sparql", app=sparql_app, name="sparql"))
+        routes.insert(-1, Mount("/sparql", app=sparql_app, name="sparql"))
         # Add a search engine
-        routes.insert(4, Route("/search", endpoint=_rdf_search(store)))
+        routes.insert(-1, Route("/search", endpoint=_rdf_search(rdf_store)))
     return routes
@@ -5,18 +5,43 @@ import logging
 import uvicorn
 from firm.interfaces import ResourceStore
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.types import ASGIApp
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
+from firm_server.adapters import HttpClientPool
+from firm_server.compression import CompressionMiddleware
 from firm_server.config import ServerConfig
-from firm_server.routes import get_routes
+from firm_server.delivery import FirmDeliveryService
+from firm_server.delivery_queue import DeliveryQueue, MemoryDeliveryQueue
+from firm_server.middleware import BodyLimitMiddleware, PeerAddressMiddleware
+from firm_server.routes import get_routes, route_labels
+from firm_server.store import observable_store
+from firm_server.timing import TimingMiddleware
 
 log = logging.getLogger(__name__ if __name__ != "__main__" else "firm_server.main")
 
 _app = None
 
 
-def app_factory(config: ServerConfig, store: ResourceStore) -> Starlette:
+def app_factory(
+    config: ServerConfig,
+    store: ResourceStore,
+    http_pool: HttpClientPool | None = None,
+    delivery_service: FirmDeliveryService | None = None,
+) -> Starlette:
     global _app
     if _app is None:
+        store = observable_store(store)
+        if http_pool is None:
+            http_pool = HttpClientPool(config.http_client)
+        # When not run by FirmServer (e.g. tests) the app runs the workers
+        # and owns the HTTP client pool they use
+        start_workers = delivery_service is None
+        if delivery_service is None:
+            delivery_service = FirmDeliveryService(
+                config, store, http_pool, MemoryDeliveryQueue()
+            )
 
         @contextlib.asynccontextmanager
         async def lifespan(app):
@@ -25,15 +50,51 @@ def app_factory(config: ServerConfig, store: ResourceStore) -> Starlette:
             # context = await context_factory(config())
             # app.state.context = context
             app.state.store = store
+            if not start_workers:
+                yield
+                return
+            await http_pool.open()
+            worker_tasks = list(map(asyncio.create_task, delivery_service.workers()))
 
             yield
 
             log.info("ASGI lifespan: stopping")
-
-        _app = Starlette(routes=get_routes(store, config), lifespan=lifespan)
+            await stop_tasks(worker_tasks)
+            await http_pool.close()
+
+        routes = get_routes(store, config, delivery_service)
+        middleware = [
+            Middleware(
+                TimingMiddleware,
+                config=config.timing,
+                route_labels=route_labels(routes),
+            ),
+            Middleware(BodyLimitMiddleware, max_size=config.request.max_body_size),
+        ]
+        if config.compression.enabled:
+            middleware.insert(
+                0, Middleware(CompressionMiddleware, config=config.compression)
+            )
+        _app = Starlette(
+            routes=routes,
+            middleware=middleware,
+            lifespan=lifespan,
+        )
     return _app
 
 
+async def stop_tasks(tasks: list[asyncio.Task]) -> None:
+    """Cancel the tasks and wait for them to finish."""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def proxied_app(app: ASGIApp) -> ASGIApp:
+    """Apply proxy headers from any host, keeping the real peer address."""
+    return PeerAddressMiddleware(ProxyHeadersMiddleware(app, trusted_hosts="*"))
+
+
 class FirmServer(uvicorn.Server):
     tasks: list[asyncio.Task] = []
 
@@ -49,11 +110,24 @@ class FirmServer(uvicorn.Server):
 
 
 async def async_run(
-    store: ResourceStore, config: ServerConfig, verbose: bool, kwargs
+    store: ResourceStore,
+    config: ServerConfig,
+    verbose: bool,
+    kwargs,
+    http_pool: HttpClientPool | None = None,
+    delivery_queue: DeliveryQueue | None = None,
 ) -> None:
-    def app_factory_with_context() -> Starlette:
-        return app_factory(config, store)
+    store = observable_store(store)
+    http_pool = http_pool or HttpClientPool(config.http_client)
+    delivery_service = FirmDeliveryService(
+        config, store, http_pool, delivery_queue or MemoryDeliveryQueue()
+    )
 
+    def app_factory_with_context() -> ASGIApp:
+        return proxied_app(app_factory(config, store, http_pool, delivery_service))
+
+    await http_pool.open()
+    worker_tasks: list[asyncio.Task] = []
     try:
         logging.getLogger("uvicorn.error").name = "uvicorn"
         server = FirmServer(
@@ -61,17 +135,18 @@ async def async_run(
                 app_factory_with_context,
                 factory=True,
                 log_config=None,
-                forwarded_allow_ips="*",
+                # Applied by proxied_app
+                proxy_headers=False,
                 **kwargs,
             )
         )
-        server.tasks = list(
-            map(
-                asyncio.create_task,
-                [server.serve()],
-            )
+        worker_tasks = list(map(asyncio.create_task, delivery_service.workers()))
+        server.tasks = [asyncio.create_task(server.serve()), *worker_tasks]
+        done, pending = await asyncio.wait(
+            server.tasks, return_when=asyncio.FIRST_COMPLETED
         )
-        done, _ = await asyncio.wait(server.tasks)
+        for task in pending:
+            task.cancel()
         for d in done:
             if d.exception() is not None:
                 raise d.exception()  # type: ignore
@@ -81,8 +156,18 @@ async def async_run(
             await server.shutdown()
         except:  # noqa
             pass
+        # The workers use the pool until they stop
+        await stop_tasks(worker_tasks)
+        await http_pool.close()
         logging.getLogger("uvicorn.error").setLevel(logging.CRITICAL)
 
 
-def run(store: ResourceStore, config: ServerConfig, verbose: bool, kwargs):
-    asyncio.run(async_run(store, config, verbose, kwargs))
+def run(
+    store: ResourceStore,
+    config: ServerConfig,
+    verbose: bool,
+    kwargs,
+    http_pool: HttpClientPool | None = None,
+    delivery_queue: DeliveryQueue | None = None,
+):
+    asyncio.run(async_run(store, config, verbose, kwargs, http_pool, delivery_queue))
@@ -1,9 +1,13 @@
+import asyncio
+import contextlib
+import contextvars
 import logging
 import os
+import uuid
 from abc import ABC, abstractmethod
-from typing import final
+from typing import Any, AsyncIterator, Callable, Iterator, final
 
-from firm.interfaces import ResourceStore
+from firm.interfaces import JSONObject, ResourceStore
 from firm.store.file import FileResourceStore
 from firm.store.prefixstore import (
     PrefixAwareResourceStore,
@@ -11,17 +15,484 @@ from firm.store.prefixstore import (
 )
 from firm_ld.store import RdfDataSet, RdfResourceStore
 
-from firm_server.adapters import HttpxTransport
+from firm_server.adapters import HttpClientPool, HttpxTransport
 from firm_server.config import FileStoreConfig, ServerConfig
+from firm_server.delivery_queue import (
+    DeliveryQueue,
+    FileDeliveryQueue,
+    MemoryDeliveryQueue,
+)
 from firm_server.exceptions import ServerException
+from firm_server.timing import phase
 
 log = logging.getLogger(__name__)
 
 
+class ResourceStoreWrapper(ResourceStore):
+    """Delegates to a wrapped store. Other attributes are forwarded too."""
+
+    def __init__(self, store: ResourceStore) -> None:
+        self.wrapped = store
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.wrapped, name)
+
+    async def get(self, uri: str) -> JSONObject | None:
+        return await self.wrapped.get(uri)
+
+    async def is_stored(self, uri: str) -> bool:
+        return await self.wrapped.is_stored(uri)
+
+    async def put(self, resource: JSONObject) -> None:
+        await self.wrapped.put(resource)
+
+    async def remove(self, uri: str) -> None:
+        await self.wrapped.remove(uri)
+
+    async def query(self, criteria: JSONObject) -> list[JSONObject]:
+        return await self.wrapped.query(criteria)
+
+    async def query_one(self, criteria: JSONObject) -> JSONObject | None:
+        return await self.wrapped.query_one(criteria)
+
+    async def get_many(self, uris: list[str]) -> list[JSONObject | None]:
+        return await get_many(self.wrapped, uris)
+
+
+async def get_many(
+    store: ResourceStore, uris: list[str], concurrency: int = 16
+) -> list[JSONObject | None]:
+    """Get several resources, in order, batched if the store supports it.
+
+    Otherwise they're fetched concurrently, at most `concurrency` at a time.
+    """
+    if callable(batched := getattr(store, "get_many", None)):
+        return await batched(uris)
+    return await _gather_gets(store, uris, concurrency)
+
+
+async def _gather_gets(
+    store: ResourceStore, uris: list[str], concurrency: int = 16
+) -> list[JSONObject | None]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _get(uri: str) -> JSONObject | None:
+        async with semaphore:
+            return await store.get(uri)
+
+    return list(await asyncio.gather(*map(_get, uris)))
+
+
+def unwrap_store(store: ResourceStore) -> ResourceStore:
+    while isinstance(store, ResourceStoreWrapper):
+        store = store.wrapped
+    return store
+
+
+LOG_HEAD = "firm:head"
+LOG_PREV = "firm:prev"
+LOG_SEGMENT_SIZE = "firm:segmentSize"
+LOG_SEGMENT_TYPE = "firm:CollectionSegment"
+_LOG_PROPERTIES = (LOG_HEAD, LOG_SEGMENT_SIZE)
+
+
+def _item_key(item: Any) -> Any:
+    if isinstance(item, dict):
+        return item.get("id") or repr(item)
+    return item
+
+
+def _is_ordered_collection(resource: JSONObject) -> bool:
+    types = resource.get("type")
+    return "OrderedCollection" in (types if isinstance(types, list) else [types])
+
+
+def _public(collection: JSONObject) -> JSONObject:
+    return {k: v for k, v in collection.items() if k not in _LOG_PROPERTIES}
+
+
+class CollectionSummary:
+    """Whether a collection was read as a summary in `collection_summaries`."""
+
+    def __init__(self, uri: str) -> None:
+        self.uri = uri
+        self.read = False
+
+
+_summary: contextvars.ContextVar[CollectionSummary | None] = contextvars.ContextVar(
+    "firm_collection_summary", default=None
+)
+
+
+@contextlib.contextmanager
+def collection_summaries(uri: str) -> Iterator[CollectionSummary]:
+    """Read a log-backed collection without its items within the block.
+
+    `get` returns it with `totalItems`, and its items can be read with
+    `iter_items`. Other resources, including other collections, are read
+    as usual.
+    """
+    summary = CollectionSummary(uri)
+    token = _summary.set(summary)
+    try:
+        yield summary
+    finally:
+        _summary.reset(token)
+
+
+class CollectionLogStore(ResourceStoreWrapper):
+    """Stores appended collections as a log of bounded segments.
+
+    A collection becomes log-backed on its first `append`. Segment `n`
+    is a private resource holding the items with sequence numbers (their
+    position counted from the oldest item) from `n * segment_size`, so
+    an append only reads and writes the newest (head) segment, and a
+    page of items is read without walking the log.
+
+    Reading a log-backed collection with `get` returns it with all its
+    `orderedItems` (newest first). `summary` and `iter_items`, or `get`
+    within `collection_summaries`, read it without assembling them.
+
+    A `put` of a log-backed collection only changes its other properties,
+    except that items added at the front of the collection it was read
+    from (a read-modify-write append) are appended. Other changes to its
+    items, including removals, are ignored and logged as warnings.
+    """
+
+    def __init__(self, store: ResourceStore, segment_size: int = 256) -> None:
+        super().__init__(store)
+        self._segment_size = segment_size
+        self._locks: dict[str, asyncio.Lock] = {}
+        # Whether collections that have been read are log-backed, so
+        # writes of other resources don't need to read them first
+        self._log_backed: dict[str, bool] = {}
+
+    def _lock(self, uri: str) -> asyncio.Lock:
+        if (lock := self._locks.get(uri)) is None:
+            lock = self._locks[uri] = asyncio.Lock()
+        return lock
+
+    @staticmethod
+    def _segment_uri(uri: str, index: int) -> str:
+        return f"urn:firm:segment:{uuid.uuid5(uuid.NAMESPACE_URL, uri)}:{index}"
+
+    def _note(self, uri: str, resource: JSONObject | None) -> None:
+        if resource is None:
+            self._log_backed.pop(uri, None)
+        elif LOG_HEAD in resource:
+            self._log_backed[uri] = True
+        elif _is_ordered_collection(resource):
+            self._log_backed[uri] = False
+
+    async def _collection(self, uri: str) -> JSONObject | None:
+        collection = await self.wrapped.get(uri)
+        self._note(uri, collection)
+        return collection
+
+    async def _items(
+        self, uri: str, collection: JSONObject, max_seq: int | None = None
+    ) -> AsyncIterator[Any]:
+        """Items of a stored collection, newest first, from `max_seq` down."""
+        if LOG_HEAD not in collection:
+            items = collection.get("orderedItems", [])
+            start = 0 if max_seq is None else max(len(items) - 1 - max_seq, 0)
+            for item in items[start:]:
+                yield item
+            return
+        size = collection[LOG_SEGMENT_SIZE]
+        seq = collection.get("totalItems", 0) - 1
+        if max_seq is not None:
+            seq = min(seq, max_seq)
+        while seq >= 0:
+            index = seq // size
+            segment = await self.wrapped.get(self._segment_uri(uri, index))
+            if segment is None:
+                log.error("Missing segment %d of collection %s", index, uri)
+                return
+            for item in reversed(segment["items"][: seq - index * size + 1]):
+                yield item
+            seq = index * size - 1
+
+    async def iter_items(self, uri: str, max_seq: int | None = None) -> AsyncIterator:
+        """Items of a collection, newest first, read one segment at a time.
+
+        With `max_seq`, items start from that sequence number.
+        """
+        if collection := await self._collection(uri):
+            async for item in self._items(uri, collection, max_seq):
+                yield item
+
+    async def summary(self, uri: str) -> JSONObject | None:
+        """A collection with its `totalItems` but without its items."""
+        if (collection := await self._collection(uri)) is None:
+            return None
+        if LOG_HEAD not in collection:
+            if "orderedItems" not in collection:
+                return collection
+            collection["totalItems"] = len(collection.pop("orderedItems"))
+            return collection
+        return _public(collection)
+
+    async def _write_log(self, uri: str, collection: JSONObject, items: list) -> None:
+        """Convert a collection to a log of items (newest first)."""
+        oldest_first = list(reversed(items))
+        head = None
+        for start in range(0, len(oldest_first), self._segment_size):
+            segment = {
+                "id": self._segment_uri(uri, start // self._segment_size),
+                "type": LOG_SEGMENT_TYPE,
+                "items": oldest_first[start : start + self._segment_size],
+                LOG_PREV: head,
+            }
+            await self.wrapped.put(segment)
+            head = segment["id"]
+        collection[LOG_HEAD] = head
+        collection[LOG_SEGMENT_SIZE] = self._segment_size
+        collection["totalItems"] = len(items)
+        await self.wrapped.put(collection)
+        self._log_backed[uri] = True
+
+    async def _append(self, uri: str, collection: JSONObject, item: Any) -> None:
+        total = collection.get("totalItems", 0)
+        index, offset = divmod(total, collection[LOG_SEGMENT_SIZE])
+        segment = None
+        if offset:
+            segment = await self.wrapped.get(self._segment_uri(uri, index))
+        if segment is None:
+            segment = {
+                "id": self._segment_uri(uri, index),
+                "type": LOG_SEGMENT_TYPE,
+                "items": [],
+                LOG_PREV: self._segment_uri(uri, index - 1) if index else None,
+            }
+        segment["items"].append(item)
+        await self.wrapped.put(segment)
+        collection[LOG_HEAD] = segment["id"]
+        collection["totalItems"] = total + 1
+        await self.wrapped.put(collection)
+
+    async def append(self, uri: str, item: Any, unique: bool = False) -> bool:
+        """Add an item to the front (newest end) of an ordered collection.
+
+        With `unique`, the item isn't added if it's already in the head
+        segment (a recent redelivery). Returns whether it was added.
+        """
+        async with self._lock(uri):
+            collection = await self._collection(uri)
+            if collection is None:
+                raise ValueError(f"Collection not found: {uri}")
+            if LOG_HEAD not in collection:
+                # Convert the collection to a log on its first append
+                items = collection.pop("orderedItems", [])
+                if unique and item in items:
+                    return False
+                await self._write_log(uri, collection, [item] + items)
+                return True
+            if unique and (total := collection.get("totalItems", 0)):
+                head = await self.wrapped.get(
+                    self._segment_uri(uri, (total - 1) // collection[LOG_SEGMENT_SIZE])
+                )
+                if head and item in head["items"]:
+                    return False
+            await self._append(uri, collection, item)
+            return True
+
+    async def get_many(self, uris: list[str]) -> list[JSONObject | None]:
+        # Log-backed collections are assembled by get
+        return await _gather_gets(self, uris)
+
+    async def get(self, uri: str) -> JSONObject | None:
+        resource = await self.wrapped.get(uri)
+        self._note(uri, resource)
+        if resource and LOG_HEAD in resource:
+            if (summary := _summary.get()) is not None and summary.uri == uri:
+                summary.read = True
+                return _public(resource)
+            items = [item async for item in self._items(uri, resource)]
+            resource = _public(resource)
+            resource["orderedItems"] = items
+            resource["totalItems"] = len(items)
+        return resource
+
+    async def put(self, resource: JSONObject) -> None:
+        uri = resource.get("id")
+        if not uri or not _is_ordered_collection(resource):
+            await self.wrapped.put(resource)
+            return
+        # Locked so a concurrent first append (converting the collection
+        # to a log) isn't overwritten
+        async with self._lock(uri):
+            if self._log_backed.get(uri) is False:
+                await self.wrapped.put(resource)
+                return
+            stored = await self._collection(uri)
+            if stored is None or LOG_HEAD not in stored:
+                await self.wrapped.put(resource)
+                return
+            collection = {
+                k: v
+                for k, v in resource.items()
+                if k not in ("orderedItems", "totalItems")
+            }
+            for key in (*_LOG_PROPERTIES, "totalItems"):
+                collection[key] = stored.get(key)
+            new_items = (
+                await self._new_items(uri, stored, resource["orderedItems"])
+                if "orderedItems" in resource
+                else []
+            )
+            if not new_items:
+                await self.wrapped.put(collection)
+            for item in reversed(new_items):
+                await self._append(uri, collection, item)
+
+    async def _new_items(self, uri: str, stored: JSONObject, items: list) -> list:
+        """Items put at the front of a log-backed collection.
+
+        They're the items before the first one that is among the newest
+        stored items (at most a segment of them, as a put that read the
+        collection before recent appends has them missing). Only those
+        are checked, so the rest of a written-back collection isn't read.
+        Any other change to the items is ignored with a warning.
+        """
+        total = stored.get("totalItems", 0)
+        if not total:
+            return list(items)
+        recent = []
+        async for item in self._items(uri, stored):
+            recent.append(_item_key(item))
+            if len(recent) >= self._segment_size:
+                break
+        positions = {key: position for position, key in enumerate(recent)}
+        for index, item in enumerate(items[: self._segment_size]):
+            if (position := positions.get(_item_key(item))) is not None:
+                # The rest must be the stored items from that one on
+                rest = items[index:]
+                if len(rest) != total - position or any(
+                    _item_key(item) != key for item, key in zip(rest, recent[position:])
+                ):
+                    self._ignored(uri)
+                return items[:index]
+        self._ignored(uri)
+        return []
+
+    @staticmethod
+    def _ignored(uri: str) -> None:
+        log.warning(
+            "Ignoring changes to the items of log-backed collection %s,"
+            " only items added at the front are stored",
+            uri,
+        )
+
+    async def remove(self, uri: str) -> None:
+        # Unlike writes, removals are rare enough to check unknown resources
+        if self._log_backed.get(uri, True):
+            async with self._lock(uri):
+                stored = await self.wrapped.get(uri)
+                if stored and LOG_HEAD in stored:
+                    size = stored[LOG_SEGMENT_SIZE]
+                    count = -(-stored.get("totalItems", 0) // size)
+                    for index in range(count):
+                        await self.wrapped.remove(self._segment_uri(uri, index))
+        self._log_backed.pop(uri, None)
+        await self.wrapped.remove(uri)
+
+
+async def append_to_collection(
+    store: ResourceStore, uri: str, item: Any, unique: bool = False
+) -> bool:
+    """Append to an ordered collection, in place if the store supports it."""
+    if callable(append := getattr(store, "append", None)):
+        return await append(uri, item, unique)
+    collection = await store.get(uri)
+    if collection is None:
+        raise ValueError(f"Collection not found: {uri}")
+    items = collection.get("orderedItems", [])
+    if unique and item in items:
+        return False
+    items.insert(0, item)
+    collection["orderedItems"] = items
+    await store.put(collection)
+    return True
+
+
+class TimedStore(ResourceStoreWrapper):
+    """Times store operations as the "store" phase of the current request."""
+
+    async def get(self, uri: str) -> JSONObject | None:
+        with phase("store"):
+            return await self.wrapped.get(uri)
+
+    async def get_many(self, uris: list[str]) -> list[JSONObject | None]:
+        with phase("store"):
+            return await get_many(self.wrapped, uris)
+
+    async def is_stored(self, uri: str) -> bool:
+        with phase("store"):
+            return await self.wrapped.is_stored(uri)
+
+    async def put(self, resource: JSONObject) -> None:
+        with phase("store"):
+            await self.wrapped.put(resource)
+
+    async def remove(self, uri: str) -> None:
+        with phase("store"):
+            await self.wrapped.remove(uri)
+
+    async def query(self, criteria: JSONObject) -> list[JSONObject]:
+        with phase("store"):
+            return await self.wrapped.query(criteria)
+
+    async def query_one(self, criteria: JSONObject) -> JSONObject | None:
+        with phase("store"):
+            return await self.wrapped.query_one(criteria)
+
+    async def append(self, uri: str, item: Any, unique: bool = False) -> bool:
+        with phase("store"):
+            return await append_to_collection(self.wrapped, uri, item, unique)
+
+
+class ObservableStore(ResourceStoreWrapper):
+    """Notifies listeners with the URI of each resource changed through it."""
+
+    def __init__(self, store: ResourceStore) -> None:
+        super().__init__(store)
+        self._listeners: list[Callable[[str], None]] = []
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        self._listeners.append(listener)
+
+    def _changed(self, uri: str) -> None:
+        for listener in self._listeners:
+            listener(uri)
+
+    async def put(self, resource: JSONObject) -> None:
+        await self.wrapped.put(resource)
+        self._changed(resource["id"])
+
+    async def remove(self, uri: str) -> None:
+        await self.wrapped.remove(uri)
+        self._changed(uri)
+
+    async def append(self, uri: str, item: Any, unique: bool = False) -> bool:
+        added = await append_to_collection(self.wrapped, uri, item, unique)
+        if added:
+            self._changed(uri)
+        return added
+
+
+def observable_store(store: ResourceStore) -> ObservableStore:
+    if isinstance(store, ObservableStore):
+        return store
+    return ObservableStore(TimedStore(store))
+
+
 class StoreDriver(ABC):
     def __init__(self, name: str) -> None:
         self.name = name
         self._store = None
+        self.http_pool: HttpClientPool | None = None
+        self.delivery_queue: DeliveryQueue | None = None
 
     @property
     def store(self) -> ResourceStore:
@@ -32,15 +503,30 @@ class StoreDriver(ABC):
 
     @final
     def open(self, config: ServerConfig) -> ResourceStore:
-        self._store = self._open(config)
+        self.http_pool = HttpClientPool(config.http_client)
+        self._store = observable_store(CollectionLogStore(self._open(config)))
+        self.delivery_queue = self._open_delivery_queue(config)
         return self._store
 
     @abstractmethod
     def _open(self, config: ServerConfig) -> ResourceStore:
         ...
 
+    def _open_delivery_queue(self, config: ServerConfig) -> DeliveryQueue:
+        if config.delivery.queue_path:
+            return FileDeliveryQueue(config.delivery.queue_path)
+        log.warning(
+            "No delivery.queue_path for the %s store,"
+            " pending deliveries are kept in memory and lost on shutdown",
+            self.name,
+        )
+        return MemoryDeliveryQueue()
+
     @final
     def close(self):
+        if self.http_pool:
+            # Called after the command's event loop has finished
+            asyncio.run(self.http_pool.close())
         if self._store and hasattr(self.store, "close"):
             self._store.close()
 
@@ -76,6 +562,7 @@ class FileSystemStoreDriver(StoreDriver):
         cls._ensure_dir_exists(os.path.join(config.path, config.tenants_subdir))
         cls._ensure_dir_exists(os.path.join(config.path, config.remote_subdir))
         cls._ensure_dir_exists(os.path.join(config.path, config.private_subdir))
+        cls._ensure_dir_exists(os.path.join(config.path, config.queue_subdir))
 
     def _open(self, config: ServerConfig) -> ResourceStore:
         if not config.store.filesystem:
@@ -100,7 +587,13 @@ class FileSystemStoreDriver(StoreDriver):
                 FileResourceStore(os.path.join(fs.path, fs.remote_subdir)),
                 FileResourceStore(os.path.join(fs.path, fs.private_subdir)),
             ),
-        ).with_transport(lambda store: HttpxTransport(store))
+        ).with_transport(lambda store: HttpxTransport(store, self.http_pool))
+
+    def _open_delivery_queue(self, config: ServerConfig) -> DeliveryQueue:
+        if config.delivery.queue_path or not config.store.filesystem:
+            return super()._open_delivery_queue(config)
+        fs = config.store.filesystem
+        return FileDeliveryQueue(os.path.join(fs.path, fs.queue_subdir))
 
 
 STORE_DRIVERS = {
@@ -0,0 +1,135 @@
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Any, Callable, Iterator
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from firm_server.config import TimingConfig
+from firm_server.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "firm_request_duration_seconds",
+    "Time to the start of the response, by route",
+    ["route", "method"],
+)
+PHASE_DURATION = REGISTRY.histogram(
+    "firm_request_phase_seconds",
+    "Time spent in each request phase, by route",
+    ["route", "phase"],
+)
+
+
+class RequestTimings:
+    """Accumulated time per phase for one request."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: dict[str, float] = {}
+
+    def add(self, name: str, duration: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total: float) -> str:
+        entries = [f"{name};dur={d * 1000:.1f}" for name, d in self.phases.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current: contextvars.ContextVar[RequestTimings | None] = contextvars.ContextVar(
+    "firm_request_timings", default=None
+)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a block as part of the current request, if there is one.
+
+    Nested or concurrent phases are each counted in full.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+class TimingMiddleware:
+    """Times requests and their phases.
+
+    Durations are recorded in per-route histograms. Requests slower than
+    the threshold are logged with their phases, and with
+    `server_timing_header` the phases are sent in a Server-Timing header.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        config: TimingConfig,
+        route_labels: dict[Callable[..., Any], str] | None = None,
+    ) -> None:
+        self.app = app
+        self.config = config
+        self.route_labels = route_labels or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current.set(timings)
+        status = 0
+        total = 0.0
+
+        async def _send(message: Message) -> None:
+            nonlocal status, total
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = timings.elapsed
+                if self.config.server_timing_header:
+                    headers = MutableHeaders(raw=message["headers"])
+                    headers.append("Server-Timing", timings.server_timing(total))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current.reset(token)
+            self._record(scope, timings, status, total or timings.elapsed)
+
+    def _record(
+        self, scope: Scope, timings: RequestTimings, status: int, total: float
+    ) -> None:
+        route = self.route_labels.get(scope.get("endpoint"), "other")
+        REQUEST_DURATION.observe(total, route=route, method=scope["method"])
+        for name, duration in timings.phases.items():
+            PHASE_DURATION.observe(duration, route=route, phase=name)
+        if total >= self.config.slow_request_threshold:
+            log.warning(
+                "Slow request %s %s (%d) took %.3fs: %s",
+                scope["method"],
+                scope["path"],
+                status,
+                total,
+                ", ".join(f"{k}={v:.3f}s" for k, v in timings.phases.items()),
+                extra={
+                    "route": route,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration": total,
+                    "phases": dict(timings.phases),
+                },
+            )
@@ -0,0 +1,330 @@
+import base64
+import hashlib
+import json
+import time
+
+import httpx
+import pytest
+from firm.auth.http_signature import HttpSignatureAuth
+from firm.interfaces import FIRM_NS, ResourceStore
+from firm.store.memory import MemoryResourceStore
+from pytest_httpx import HTTPXMock
+
+from firm_server.adapters import HttpClientPool
+from firm_server.config import (
+    DeliveryConfig,
+    FileStoreConfig,
+    PublicKeyCacheConfig,
+    ServerConfig,
+    StoreDriverConfigs,
+)
+from firm_server.delivery import (
+    BYTES_SENT,
+    LATENCY,
+    RESPONSES,
+    DeliveryPayload,
+    FirmDeliveryService,
+    Recipient,
+    plan_delivery,
+)
+from firm_server.delivery_queue import (
+    DeliveryJob,
+    DeliveryQueue,
+    FileDeliveryQueue,
+    MemoryDeliveryQueue,
+)
+from firm_server.keys import PublicKeyCache, SigningKeyCache
+from firm_server.metrics import REGISTRY
+from firm_server.store import ObservableStore
+from tests.test_server import PRIVATE_KEY, PUBLIC_KEY
+
+PREFIX = "https://firm.stevebate.dev"
+ACTOR_URI = f"{PREFIX}/actor/steve"
+
+
+@pytest.fixture
+def store() -> ResourceStore:
+    return MemoryResourceStore()
+
+
+@pytest.fixture
+def config() -> ServerConfig:
+    return ServerConfig(
+        [PREFIX],
+        StoreDriverConfigs(None, FileStoreConfig("data")),
+        delivery=DeliveryConfig(max_concurrency=4, max_concurrency_per_host=1),
+    )
+
+
+@pytest.fixture
+async def http_pool():
+    pool = HttpClientPool()
+    yield pool
+    await pool.close()
+
+
+@pytest.fixture
+def queue() -> DeliveryQueue:
+    return MemoryDeliveryQueue()
+
+
+@pytest.fixture
+def service(config, store, http_pool, queue) -> FirmDeliveryService:
+    return FirmDeliveryService(config, store, http_pool, queue)
+
+
+@pytest.fixture
+async def actor(store: ResourceStore):
+    actor = {
+        "id": ACTOR_URI,
+        "type": "Person",
+        "inbox": f"{ACTOR_URI}/inbox",
+        "publicKey": {
+            "id": f"{ACTOR_URI}#main-key",
+            "owner": ACTOR_URI,
+            "publicKeyPem": PUBLIC_KEY,
+        },
+    }
+    await store.put(actor)
+    await store.put(
+        {
+            "id": "urn:uuid:credentials",
+            "type": [FIRM_NS.Credentials.value],
+            "attributedTo": ACTOR_URI,
+            FIRM_NS.privateKey.value: PRIVATE_KEY,
+        }
+    )
+    return actor
+
+
+async def _add_remote_actors(store: ResourceStore, count: int) -> list[str]:
+    uris = []
+    for i in range(count):
+        uri = f"https://remote{i}.test/actor/bob"
+        await store.put({"id": uri, "type": "Person", "inbox": f"{uri}/inbox"})
+        uris.append(uri)
+    return uris
+
+
+async def test_deliver_enqueues(store, service, queue, actor, httpx_mock: HTTPXMock):
+    recipients = await _add_remote_actors(store, 5)
+    httpx_mock.add_response(method="POST", status_code=202)
+    await service.deliver(
+        {
+            "id": f"{ACTOR_URI}/activity/1",
+            "type": "Create",
+            "actor": ACTOR_URI,
+            "to": recipients,
+        }
+    )
+    assert len(queue) == 1
+    assert not httpx_mock.get_requests()
+    await service._process(await queue.get())
+    requests = httpx_mock.get_requests()
+    assert {str(r.url) for r in requests} == {f"{uri}/inbox" for uri in recipients}
+    assert len(queue) == 0
+
+
+async def test_deliver_retries_failed_inbox(
+    store, service, queue, actor, httpx_mock: HTTPXMock
+):
+    recipients = await _add_remote_actors(store, 2)
+    httpx_mock.add_response(
+        method="POST", status_code=503, url="https://remote0.test/actor/bob/inbox"
+    )
+    httpx_mock.add_response(method="POST", status_code=202)
+    await service.deliver(
+        {
+            "id": f"{ACTOR_URI}/activity/1",
+            "type": "Create",
+            "actor": ACTOR_URI,
+            "to": recipients,
+        }
+    )
+    await service._process(await queue.get())
+    assert len(queue) == 1
+    job = queue._jobs[next(iter(queue._jobs))]
+    assert list(job.inboxes) == ["https://remote0.test/actor/bob/inbox"]
+    assert job.inboxes["https://remote0.test/actor/bob/inbox"].attempts == 1
+    assert job.next_attempt > job.created
+
+
+async def test_deliver_defers_probed_host(
+    store, service, http_pool, queue, actor, httpx_mock: HTTPXMock
+):
+    recipients = await _add_remote_actors(store, 1)
+    inbox = f"{recipients[0]}/inbox"
+    # The circuit is half-open and another request is probing the host
+    http_pool.health["remote0.test"].opened_at = time.monotonic()
+    assert http_pool.health.allow("remote0.test")
+    await service.deliver(
+        {
+            "id": f"{ACTOR_URI}/activity/1",
+            "type": "Create",
+            "actor": ACTOR_URI,
+            "to": recipients,
+        }
+    )
+    skipped = RESPONSES.value(host="remote0.test", status="not_attempted")
+    latencies = LATENCY.count(host="remote0.test")
+    await service._process(await queue.get())
+    assert not httpx_mock.get_requests()
+    job = queue._jobs[next(iter(queue._jobs))]
+    assert job.inboxes[inbox].attempts == 0
+    # Counted apart from failures, with no latency sample
+    assert RESPONSES.value(host="remote0.test", status="not_attempted") == skipped + 1
+    assert LATENCY.count(host="remote0.test") == latencies
+    assert job.inboxes[inbox].next_attempt > time.time()
+
+
+async def test_deliver_failure_does_not_stop_batch(
+    store, service, actor, httpx_mock: HTTPXMock
+):
+    recipients = await _add_remote_actors(store, 3)
+    httpx_mock.add_exception(
+        httpx.ConnectTimeout("timeout"), url="https://remote0.test/actor/bob/inbox"
+    )
+    httpx_mock.add_response(method="POST", status_code=202)
+    results = await service._post_all(
+        [f"{uri}/inbox" for uri in recipients],
+        DeliveryPayload.from_activity({"type": "Create"}),
+        HttpSignatureAuth(f"{ACTOR_URI}#main-key", PRIVATE_KEY),
+    )
+    assert results == {
+        "https://remote0.test/actor/bob/inbox": None,
+        "https://remote1.test/actor/bob/inbox": 202,
+        "https://remote2.test/actor/bob/inbox": 202,
+    }
+
+
+def test_plan_delivery_collapses_shared_inboxes():
+    plan = plan_delivery(
+        [
+            Recipient("https://small.test/actor/a/inbox"),
+            Recipient("https://big.test/actor/a/inbox", "https://big.test/inbox"),
+            Recipient("https://big.test/actor/b/inbox", "https://big.test/inbox"),
+            Recipient("https://big.test/actor/c/inbox", "https://big.test/inbox"),
+            Recipient("https://big.test/actor/d/inbox"),
+        ]
+    )
+    assert list(plan.hosts) == ["big.test", "small.test"]
+    assert plan.inboxes == [
+        "https://big.test/inbox",
+        "https://big.test/actor/d/inbox",
+        "https://small.test/actor/a/inbox",
+    ]
+    assert plan.posts_saved == 2
+
+
+async def test_resolve_recipients_cached_and_cycle_safe(store, service):
+    recipients = await _add_remote_actors(store, 3)
+    followers = f"{ACTOR_URI}/followers"
+    await store.put(
+        {
+            "id": followers,
+            "type": "Collection",
+            # A collection that (indirectly) contains itself
+            "items": recipients + [followers],
+        }
+    )
+    resolved = await service._resolve_recipients([followers])
+    assert set(resolved) == set(recipients)
+    for uri in recipients:
+        await store.remove(uri)
+    assert await service._resolve_recipients([followers]) == resolved
+
+
+async def test_signing_key_cache(store, actor):
+    observable = ObservableStore(store)
+    keys = SigningKeyCache(observable)
+    observable.add_listener(keys.changed)
+    auth = await keys.get(ACTOR_URI)
+    assert auth is not None
+    assert await keys.get(ACTOR_URI) is auth
+    await observable.remove("urn:uuid:credentials")
+    assert await keys.get(ACTOR_URI) is None
+
+
+async def test_signing_key_cache_revalidation(store, actor):
+    keys = SigningKeyCache(store, max_age=0)
+    auth = await keys.get(ACTOR_URI)
+    credentials = await store.get("urn:uuid:credentials")
+    credentials[FIRM_NS.role.value] = ["admin"]
+    await store.put(credentials)
+    # The key is unchanged
+    assert await keys.get(ACTOR_URI) is auth
+    # Changes made without notifying the cache are found once it's stale
+    await store.remove("urn:uuid:credentials")
+    assert await keys.get(ACTOR_URI) is None
+
+
+async def test_public_key_cache(store, config):
+    key_uri = "https://remote.test/actor/bob#main-key"
+    keys = PublicKeyCache(
+        store, config.is_local, PublicKeyCacheConfig(min_refresh_interval=0)
+    )
+    view = keys.view()
+    assert await view.get(key_uri) is None
+    await store.put({"id": key_uri, "publicKeyPem": PUBLIC_KEY})
+    # Negative entry
+    assert await view.get(key_uri) is None
+    keys.invalidate(view.refreshable)
+    assert (await keys.view().get(key_uri))["publicKeyPem"] == PUBLIC_KEY
+    await store.remove(key_uri)
+    view = keys.view()
+    assert (await view.get(key_uri))["publicKeyPem"] == PUBLIC_KEY
+    assert view.refreshable == {key_uri}
+    # Local documents aren't cached
+    assert await keys.view().get(ACTOR_URI) is None
+
+
+def test_delivery_payload_strips_private_properties():
+    payload = DeliveryPayload.from_activity(
+        {
+            "id": f"{ACTOR_URI}/activity/1",
+            "type": "Create",
+            "bcc": ["https://remote.test/actor/bob"],
+            "firm:internal": True,
+            "object": {"type": "Note", "bto": [ACTOR_URI], "firm:internal": 1},
+        }
+    )
+    assert json.loads(payload.body) == {
+        "id": f"{ACTOR_URI}/activity/1",
+        "type": "Create",
+        "object": {"type": "Note"},
+    }
+    digest = base64.b64encode(hashlib.sha256(payload.body).digest()).decode()
+    assert payload.digest == f"SHA-256={digest}"
+
+
+async def test_delivery_metrics(store, service, queue, actor, httpx_mock: HTTPXMock):
+    recipients = await _add_remote_actors(store, 2)
+    httpx_mock.add_response(method="POST", status_code=202)
+    sent = BYTES_SENT.value(host="remote0.test")
+    await service.deliver(
+        {
+            "id": f"{ACTOR_URI}/activity/1",
+            "type": "Create",
+            "actor": ACTOR_URI,
+            "to": recipients,
+        }
+    )
+    assert REGISTRY.get("firm_delivery_queue_depth").value() == 1
+    await service._process(await queue.get())
+    assert REGISTRY.get("firm_delivery_queue_depth").value() == 0
+    assert RESPONSES.value(host="remote0.test", status="202") >= 1
+    assert LATENCY.count(host="remote0.test") >= 1
+    assert BYTES_SENT.value(host="remote0.test") > sent
+
+
+async def test_file_delivery_queue(tmp_path):
+    queue = FileDeliveryQueue(str(tmp_path))
+    job = DeliveryJob({"id": f"{ACTOR_URI}/activity/1"})
+    await queue.put(job)
+    assert (tmp_path / f"{job.id}.json").exists()
+
+    # Pending jobs are recovered when the queue is reopened
+    recovered = FileDeliveryQueue(str(tmp_path))
+    assert (await recovered.get()).activity == job.activity
+    await recovered.remove(job.id)
+    assert not list(tmp_path.iterdir())
@@ -1,4 +1,8 @@
+import logging
 import os
+import time
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
 
 import pytest
 from firm.auth.http_signature import HttpSignatureAuth
@@ -7,9 +11,28 @@ from firm.store.memory import MemoryResourceStore
 from pytest_httpx import HTTPXMock
 from starlette.testclient import TestClient
 
-from firm_server.adapters import HttpxTransport
-from firm_server.config import FileStoreConfig, ServerConfig, StoreDriverConfigs
+from firm_server import server
+from firm_server.adapters import HttpClientPool, HttpxTransport
+from firm_server.conditional import ResourceVersions
+from firm_server.config import (
+    FileStoreConfig,
+    HostHealthConfig,
+    HttpClientConfig,
+    MetricsConfig,
+    RequestConfig,
+    ServerConfig,
+    StoreDriverConfigs,
+    TemplatesConfig,
+    TimingConfig,
+)
+from firm_server.encoding import JSONResponse
+from firm_server.health import CircuitOpenError, HostHealthRegistry
+from firm_server.html.endpoint import _configure_tenant_templates, _precompile
+from firm_server.html.static import StaticManifest
+from firm_server.paging import page_collection
+from firm_server.response_cache import ResponseCache
 from firm_server.server import app_factory
+from firm_server.timing import REQUEST_DURATION
 
 
 @pytest.fixture(autouse=True)
@@ -18,7 +41,9 @@ def store() -> ResourceStore:
 
 
 @pytest.fixture
-def client(store):
+def client(store, monkeypatch):
+    # app_factory returns a cached app
+    monkeypatch.setattr(server, "_app", None)
     prefix = "https://firm.stevebate.dev"
     with TestClient(
         app_factory(
@@ -112,6 +137,104 @@ class FirmServerTestBase:
         assert data["id"] == "https://firm.stevebate.dev/actor/steve"
 
 
+async def test_conditional_get(client, store):
+    uri = "https://firm.stevebate.dev/actor/steve"
+    headers = {"Accept": "application/activity+json"}
+    # Written without a change notification, like data from before a restart
+    await store.put({"id": uri, "type": "Person"})
+    response = client.get(uri, headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    response = client.get(uri, headers=headers | {"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    assert response.headers["last-modified"] == last_modified
+
+    response = client.get(uri, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert not response.content
+
+    # Changes through the server's store replace the validator
+    await client.app.state.store.put({"id": uri, "type": "Person", "name": "x"})
+    response = client.get(uri, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+async def test_page_cache(client):
+    uri = "https://firm.stevebate.dev/note/1"
+    headers = {"Accept": "text/html"}
+    store = client.app.state.store
+    await store.put({"id": uri, "type": "Note", "content": "first"})
+    response = client.get(uri, headers=headers)
+    assert response.status_code == 200
+    assert "first" in response.text
+    etag = response.headers["etag"]
+
+    response = client.get(uri, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # Pages are re-rendered when their resource changes
+    await store.put({"id": uri, "type": "Note", "content": "second"})
+    response = client.get(uri, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "second" in response.text
+
+
+def test_resource_versions():
+    uri = "https://firm.stevebate.dev/actor/steve"
+    versions = ResourceVersions(ttl=60)
+    version = versions.put(versions.begin(uri), uri, "json", b"{}")
+    assert versions.find(uri, "json") == version
+    assert versions.find(uri, "ld+json") is None
+    # Content hashes don't depend on the process
+    other = ResourceVersions(ttl=60).put(object(), uri, "json", b"{}")
+    assert other.etag == version.etag
+    # Without a recorded change, the version is as new as when it was served
+    assert version.modified
+
+    # A failed or uncached response leaves other validators alone
+    versions.abort(versions.begin(uri), uri)
+    assert versions.find(uri, "json") == version
+
+    versions.changed(uri)
+    assert versions.find(uri, "json") is None
+    assert versions.put(versions.begin(uri), uri, "json", b"{}").modified
+
+
+def test_metrics(store, monkeypatch):
+    prefix = "https://firm.stevebate.dev"
+    for allowed_clients, served in [([], False), (["testclient"], True)]:
+        monkeypatch.setattr(server, "_app", None)
+        config = ServerConfig(
+            [prefix],
+            StoreDriverConfigs(None, FileStoreConfig("data")),
+            metrics=MetricsConfig(enabled=True, allowed_clients=allowed_clients),
+        )
+        with TestClient(app_factory(config, store), base_url=prefix) as client:
+            response = client.get(f"{prefix}/metrics")
+        assert ("# TYPE firm_delivery_queue_depth gauge" in response.text) == served
+
+
+def test_metrics_forwarded_for(store, monkeypatch):
+    monkeypatch.setattr(server, "_app", None)
+    prefix = "https://firm.stevebate.dev"
+    config = ServerConfig(
+        [prefix],
+        StoreDriverConfigs(None, FileStoreConfig("data")),
+        metrics=MetricsConfig(enabled=True, allowed_clients=["127.0.0.1"]),
+    )
+    app = server.proxied_app(app_factory(config, store))
+    with TestClient(app, base_url=prefix) as client:
+        # An allowed address in X-Forwarded-For doesn't make it the peer
+        response = client.get(
+            f"{prefix}/metrics", headers={"X-Forwarded-For": "127.0.0.1"}
+        )
+    assert "# TYPE firm_delivery_queue_depth gauge" not in response.text
+
+
 class TestServer(FirmServerTestBase):
     ...
 
@@ -154,6 +277,39 @@ async def test_http_transport_get(httpx_mock: HTTPXMock):
     assert data["id"] == "https://remote.test/actor/bob"
 
 
+async def test_http_transport_pooled_get(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(
+        method="GET",
+        json={
+            "id": "https://remote.test/actor/bob",
+        },
+    )
+    pool = HttpClientPool()
+    transport = HttpxTransport(MemoryResourceStore(), pool)
+    try:
+        response = await transport.get("https://remote.test/actor/bob")
+        assert response.status_code == 200
+        assert pool.client is pool.client
+    finally:
+        await pool.close()
+
+
+async def test_http_client_pool_closed():
+    pool = HttpClientPool()
+    await pool.open()
+    client = pool.client
+    await pool.close()
+    assert client.is_closed
+    with pytest.raises(RuntimeError):
+        pool.client
+    # Reopening makes the pool usable again
+    await pool.open()
+    try:
+        assert not pool.client.is_closed
+    finally:
+        await pool.close()
+
+
 async def test_http_transport_post(httpx_mock: HTTPXMock):
     httpx_mock.add_response(method="POST", status_code=403)
     transport = HttpxTransport(MemoryResourceStore())
@@ -163,3 +319,236 @@ async def test_http_transport_post(httpx_mock: HTTPXMock):
         auth=HttpSignatureAuth("https://remote.test/actor/bob", PRIVATE_KEY),
     )
     assert response.status_code == 403
+
+
+def test_host_health_circuit():
+    health = HostHealthRegistry(
+        HostHealthConfig(failure_threshold=2, reset_timeout=0.05)
+    )
+    for _ in range(2):
+        assert health.allow("remote.test")
+        health.record("remote.test", False, 0.1)
+    assert health.is_open("remote.test")
+    assert not health.allow("remote.test")
+    time.sleep(0.06)
+    # half-open, only one probe is allowed
+    probe = health.allow("remote.test")
+    assert probe
+    assert not health.allow("remote.test")
+    assert health.is_open("remote.test")
+    # Only the probe's outcome ends probing
+    health.record("remote.test", False, 0.1)
+    assert not health.allow("remote.test")
+    health.record("remote.test", True, 0.01, probe)
+    assert health.allow("remote.test")
+    assert health["remote.test"].consecutive_failures == 0
+
+
+async def test_http_transport_circuit_open(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method="GET", status_code=503)
+    pool = HttpClientPool(
+        HttpClientConfig(host_health=HostHealthConfig(failure_threshold=1))
+    )
+    transport = HttpxTransport(MemoryResourceStore(), pool)
+    try:
+        response = await transport.get("https://remote.test/actor/bob")
+        assert response.status_code == 503
+        with pytest.raises(CircuitOpenError):
+            await transport.get("https://remote.test/actor/bob")
+    finally:
+        await pool.close()
+
+
+def test_json_response_encoding():
+    assert JSONResponse({"name": "Zoë", "items": [1]}).body == (
+        '{"name":"Zoë","items":[1]}'.encode()
+    )
+    # Already encoded documents are sent as is
+    assert JSONResponse(b'{"id":"x"}').body == b'{"id":"x"}'
+
+
+def test_response_cache():
+    uri = "https://firm.stevebate.dev/actor/steve"
+    cache = ResponseCache(max_bytes=200, ttl=60)
+    token = cache.begin(uri)
+    cache.put(token, uri, "json", JSONResponse({"id": uri}))
+    assert cache.get(uri, "json").body == f'{{"id":"{uri}"}}'.encode()
+    assert cache.get(uri, "ld+json") is None
+
+    # A resource changed while its response was computed isn't cached
+    token = cache.begin(uri)
+    cache.invalidate(uri)
+    assert cache.get(uri, "json") is None
+    cache.put(token, uri, "json", JSONResponse({"id": uri}))
+    assert cache.get(uri, "json") is None
+
+    # Fills that aren't stored (e.g. 404s) don't leave anything behind
+    cache.abort(cache.begin(f"{uri}/missing"), f"{uri}/missing")
+    assert not cache._pending
+
+    # Least recently used entries are evicted to stay within the size bound
+    for n in range(5):
+        cache.put(cache.begin(f"{uri}/{n}"), f"{uri}/{n}", "json", JSONResponse(n))
+    assert cache.size <= cache.max_bytes
+    assert cache.get(f"{uri}/0", "json") is None
+    assert cache.get(f"{uri}/4", "json") is not None
+
+
+def test_page_collection():
+    uri = "https://firm.stevebate.dev/actor/steve/outbox"
+    items = [f"{uri}/{n}" for n in range(5, 0, -1)]  # newest first
+    collection = {"id": uri, "type": "OrderedCollection", "orderedItems": items}
+    assert page_collection(collection, {}, 10) == collection
+
+    summary = page_collection(collection, {}, 2)
+    assert "orderedItems" not in summary
+    assert summary["totalItems"] == 5
+    assert summary["first"] == f"{uri}?page=true"
+
+    first = page_collection(collection, {"page": "true"}, 2)
+    assert first["type"] == "OrderedCollectionPage"
+    assert first["partOf"] == uri
+    assert first["orderedItems"] == items[:2]
+    assert "prev" not in first
+
+    # Cursors are stable when newer items are added
+    collection["orderedItems"] = [f"{uri}/6"] + items
+    query = dict(parse_qsl(urlsplit(first["next"]).query))
+    second = page_collection(collection, query, 2)
+    assert second["orderedItems"] == items[2:4]
+    query = dict(parse_qsl(urlsplit(second["prev"]).query))
+    assert page_collection(collection, query, 2)["orderedItems"] == items[:2]
+
+
+def test_oversized_body_rejected(client):
+    response = client.post(
+        "https://firm.stevebate.dev/actor/steve/inbox",
+        content=b"x" * (RequestConfig().max_body_size + 1),
+        headers={"Content-Type": "application/activity+json"},
+    )
+    assert response.status_code == 413
+
+
+def test_static_precompressed(client):
+    response = client.get(
+        "https://firm.stevebate.dev/static/css/styles.css",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert response.is_success
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    plain = client.get(
+        "https://firm.stevebate.dev/static/css/styles.css",
+        headers={"Accept-Encoding": "identity"},
+    )
+    assert response.headers["etag"] == plain.headers["etag"][:-1] + '-gzip"'
+    static_dir = Path(__file__).parent.parent / "firm_server/html/static"
+    assert response.text == (static_dir / "css/styles.css").read_text()
+
+    # A 304 has the validators of the 200 it stands for
+    not_modified = client.get(
+        "https://firm.stevebate.dev/static/css/styles.css",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]},
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == response.headers["etag"]
+    assert not_modified.headers["vary"] == "Accept-Encoding"
+
+
+def test_static_caching(client):
+    response = client.get("https://firm.stevebate.dev/static/css/styles.css")
+    etag = response.headers["etag"]
+    assert "immutable" not in response.headers["cache-control"]
+    response = client.get(
+        "https://firm.stevebate.dev/static/css/styles.css",
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+    # Fingerprinted URLs are used in pages and can be cached indefinitely
+    response = client.get(
+        "https://firm.stevebate.dev/login", headers={"Accept": "text/html"}
+    )
+    fingerprint = etag.strip('"')[:12]
+    url = f"/static/css/styles.{fingerprint}.css"
+    assert url in response.text
+    response = client.get(f"https://firm.stevebate.dev{url}")
+    assert response.is_success
+    assert "immutable" in response.headers["cache-control"]
+
+
+def test_server_timing(store, monkeypatch):
+    monkeypatch.setattr(server, "_app", None)
+    prefix = "https://firm.stevebate.dev"
+    config = ServerConfig(
+        [prefix],
+        StoreDriverConfigs(None, FileStoreConfig("data")),
+        timing=TimingConfig(server_timing_header=True),
+    )
+    with TestClient(app_factory(config, store), base_url=prefix) as client:
+        response = client.get(
+            f"{prefix}/actor/steve", headers={"Accept": "application/activity+json"}
+        )
+    assert "store;dur=" in response.headers["server-timing"]
+    assert "total;dur=" in response.headers["server-timing"]
+    assert REQUEST_DURATION.count(route="activitypub", method="GET") > 0
+
+
+async def test_streamed_page(store, monkeypatch):
+    monkeypatch.setattr(server, "_app", None)
+    prefix = "https://firm.stevebate.dev"
+    config = ServerConfig(
+        [prefix],
+        StoreDriverConfigs(None, FileStoreConfig("data")),
+        templates=TemplatesConfig(streaming=True),
+    )
+    uri = f"{prefix}/note/1"
+    with TestClient(app_factory(config, store), base_url=prefix) as client:
+        await client.app.state.store.put({"id": uri, "type": "Note", "content": "hi"})
+        response = client.get(uri, headers={"Accept": "text/html"})
+        assert response.status_code == 200
+        assert "hi" in response.text
+        assert "etag" not in response.headers
+        # The streamed page was cached as it was sent
+        cached = client.get(uri, headers={"Accept": "text/html"})
+        assert cached.text == response.text
+        assert "etag" in cached.headers
+
+
+@pytest.fixture
+def tenant_templates(monkeypatch):
+    # Template directories are relative to the repository root
+    monkeypatch.chdir(Path(__file__).parent.parent)
+    config = ServerConfig(
+        ["https://firm.stevebate.dev", "https://firm.technoetic.com"],
+        StoreDriverConfigs(None, FileStoreConfig("data")),
+        templates=TemplatesConfig(bytecode_cache=False),
+    )
+    return _configure_tenant_templates(config, StaticManifest(config))
+
+
+def test_tenant_template_overlay(tenant_templates):
+    default = tenant_templates["https://firm.stevebate.dev"]
+    tenant = tenant_templates["https://firm.technoetic.com"]
+    overridden = tenant.get_template("home.jinja2").filename
+    assert Path(overridden).parts[-3:] == (
+        "firm.technoetic.com",
+        "templates",
+        "home.jinja2",
+    )
+    assert default.get_template("home.jinja2").filename != overridden
+    # Other templates come from the defaults
+    assert (
+        tenant.get_template("login.jinja2").filename
+        == default.get_template("login.jinja2").filename
+    )
+
+
+def test_precompile_templates(tenant_templates, caplog):
+    environments = {id(t.env): t.env for t in tenant_templates.values()}
+    count = sum(
+        len(env.list_templates(extensions=["jinja2"])) for env in environments.values()
+    )
+    with caplog.at_level(logging.INFO):
+        _precompile(environments.values())
+    assert f"Compiled {count} templates" in caplog.text
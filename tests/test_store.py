@@ -0,0 +1,165 @@
+import asyncio
+from urllib.parse import parse_qsl, urlsplit
+
+from firm.store.memory import MemoryResourceStore
+
+from firm_server.paging import page_log_collection
+from firm_server.store import (
+    CollectionLogStore,
+    append_to_collection,
+    collection_summaries,
+    get_many,
+)
+
+INBOX_URI = "https://firm.stevebate.dev/actor/steve/inbox"
+
+
+async def test_collection_log_append():
+    inner = MemoryResourceStore()
+    store = CollectionLogStore(inner, segment_size=2)
+    await inner.put(
+        {"id": INBOX_URI, "type": "OrderedCollection", "orderedItems": ["b", "a"]}
+    )
+
+    for item in "cde":
+        assert await store.append(INBOX_URI, item, unique=True)
+    # Redelivery of a recent item is ignored
+    assert not await store.append(INBOX_URI, "e", unique=True)
+
+    inbox = await store.get(INBOX_URI)
+    assert inbox["orderedItems"] == ["e", "d", "c", "b", "a"]
+    assert inbox["totalItems"] == 5
+    assert [item async for item in store.iter_items(INBOX_URI)] == list("edcba")
+
+    # The stored collection document doesn't hold the items
+    assert "orderedItems" not in await inner.get(INBOX_URI)
+
+
+async def test_collection_log_put(caplog):
+    store = CollectionLogStore(MemoryResourceStore(), segment_size=2)
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection"})
+    await append_to_collection(store, INBOX_URI, "a")
+
+    # Writing back a collection with a new first item appends it
+    inbox = await store.get(INBOX_URI)
+    inbox["orderedItems"].insert(0, "b")
+    await store.put(inbox)
+    assert (await store.get(INBOX_URI))["orderedItems"] == ["b", "a"]
+
+    # A stale read-modify-write still appends its new item
+    stale = await store.get(INBOX_URI)
+    await store.append(INBOX_URI, "c")
+    stale["orderedItems"].insert(0, "d")
+    await store.put(stale)
+    assert (await store.get(INBOX_URI))["orderedItems"] == ["d", "c", "b", "a"]
+
+    assert "Ignoring changes" not in caplog.text
+
+    # Other changes to the items are ignored, other properties are kept
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection", "name": "x"})
+    await store.put({**inbox, "orderedItems": ["x"]})
+    inbox = await store.get(INBOX_URI)
+    assert inbox["orderedItems"] == ["d", "c", "b", "a"]
+    assert inbox["totalItems"] == 4
+    assert "Ignoring changes" in caplog.text
+
+    # Including removals, which are logged too
+    caplog.clear()
+    await store.put({**inbox, "orderedItems": ["d", "c", "a"]})
+    assert (await store.get(INBOX_URI))["orderedItems"] == ["d", "c", "b", "a"]
+    assert "Ignoring changes" in caplog.text
+
+
+class _HeldWritesStore(MemoryResourceStore):
+    """Holds writes of collection items until released."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def put(self, resource) -> None:
+        if "orderedItems" in resource:
+            await self.released.wait()
+        await super().put(resource)
+
+
+async def test_collection_log_put_during_first_append():
+    inner = _HeldWritesStore()
+    inner.released.set()
+    store = CollectionLogStore(inner)
+    collection = {"id": INBOX_URI, "type": "OrderedCollection", "orderedItems": []}
+    await store.put(collection)
+
+    inner.released.clear()
+    put = asyncio.create_task(store.put({**collection, "name": "inbox"}))
+    append = asyncio.create_task(store.append(INBOX_URI, "a"))
+    for _ in range(5):
+        await asyncio.sleep(0)
+    inner.released.set()
+    await asyncio.gather(put, append)
+    # The put doesn't overwrite the log the append created
+    inbox = await store.get(INBOX_URI)
+    assert inbox["orderedItems"] == ["a"]
+    assert inbox["name"] == "inbox"
+
+
+async def test_collection_log_reads():
+    store = CollectionLogStore(MemoryResourceStore(), segment_size=2)
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection"})
+    for item in "abcde":
+        await store.append(INBOX_URI, item)
+
+    summary = await store.summary(INBOX_URI)
+    assert summary["totalItems"] == 5
+    assert "orderedItems" not in summary
+    # Items from a sequence number (position from the oldest item)
+    assert [item async for item in store.iter_items(INBOX_URI, max_seq=2)] == list(
+        "cba"
+    )
+
+
+async def test_paged_collection_log():
+    store = CollectionLogStore(MemoryResourceStore(), segment_size=2)
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection"})
+    for item in "abcde":
+        await store.append(INBOX_URI, item)
+
+    with collection_summaries(INBOX_URI) as summary:
+        inbox = await store.get(INBOX_URI)
+    assert summary.read
+    assert "orderedItems" not in inbox
+
+    first = await page_log_collection(inbox, {"page": "true"}, 2, store.iter_items)
+    assert first["orderedItems"] == ["e", "d"]
+    query = dict(parse_qsl(urlsplit(first["next"]).query))
+    second = await page_log_collection(inbox, query, 2, store.iter_items)
+    assert second["orderedItems"] == ["c", "b"]
+    query = dict(parse_qsl(urlsplit(second["prev"]).query))
+    previous = await page_log_collection(inbox, query, 2, store.iter_items)
+    assert previous["orderedItems"] == ["e", "d"]
+    # A collection that fits in a page is returned whole
+    whole = await page_log_collection(inbox, {}, 10, store.iter_items)
+    assert whole["orderedItems"] == list("edcba")
+
+
+async def test_append_to_plain_store():
+    store = MemoryResourceStore()
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection"})
+    await append_to_collection(store, INBOX_URI, "a")
+    await append_to_collection(store, INBOX_URI, "a", unique=True)
+    assert (await store.get(INBOX_URI))["orderedItems"] == ["a"]
+
+
+async def test_get_many():
+    inner = MemoryResourceStore()
+    store = CollectionLogStore(inner, segment_size=2)
+    await store.put({"id": INBOX_URI, "type": "OrderedCollection"})
+    await store.append(INBOX_URI, "a")
+    await inner.put({"id": "urn:test:1"})
+
+    resources = await get_many(store, ["urn:test:1", "urn:test:missing", INBOX_URI])
+    assert resources[0] == {"id": "urn:test:1"}
+    assert resources[1] is None
+    assert resources[2]["orderedItems"] == ["a"]
+    # Stores without get_many
+    assert await get_many(inner, ["urn:test:1"]) == [{"id": "urn:test:1"}]
@@ -0,0 +1,35 @@
+from firm.store.memory import MemoryResourceStore
+
+from firm_server.html.timeline import ActorTimelines
+from firm_server.store import CollectionLogStore, observable_store
+
+OUTBOX_URI = "https://firm.stevebate.dev/actor/steve/outbox"
+
+
+async def _post(store, n: int, activity_type: str = "Create"):
+    note_uri = f"https://firm.stevebate.dev/note/{n}"
+    await store.put({"id": note_uri, "type": "Note"})
+    activity_uri = f"https://firm.stevebate.dev/activity/{n}"
+    await store.put({"id": activity_uri, "type": activity_type, "object": note_uri})
+    await store.append(OUTBOX_URI, activity_uri)
+    return note_uri
+
+
+async def test_actor_timeline():
+    store = observable_store(CollectionLogStore(MemoryResourceStore()))
+    timelines = ActorTimelines()
+    store.add_listener(timelines.changed)
+    await store.put({"id": OUTBOX_URI, "type": "OrderedCollection"})
+
+    first = await _post(store, 1)
+    await store.append(OUTBOX_URI, "https://firm.stevebate.dev/activity/like")
+    assert [d["id"] for d in await timelines.get(OUTBOX_URI, store)] == [first]
+
+    # New outbox items are added
+    second = await _post(store, 2)
+    timeline = await timelines.get(OUTBOX_URI, store)
+    assert [d["id"] for d in timeline] == [second, first]
+
+    # Deleted documents are dropped
+    await store.put({"id": second, "type": "Tombstone"})
+    assert [d["id"] for d in await timelines.get(OUTBOX_URI, store)] == [first]